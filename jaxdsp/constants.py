@@ -0,0 +1,2 @@
+# Sample rate assumed when none is provided.
+DEFAULT_SAMPLE_RATE = 44100
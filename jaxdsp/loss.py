@@ -1,29 +1,65 @@
 import functools
 
+import numpy as np
 import jax.numpy as jnp
 from jax import jit
-import jax_spectral
 
-# Port of https://github.com/magenta/ddsp/blob/master/ddsp/spectral_ops.py#L33,
-# but using https://github.com/cifkao/jax-spectral instead of tf.signal.stft
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
+
+
+@functools.lru_cache()
+def stft_window(frame_size):
+    """Periodic Hann window, normalized to unit sum."""
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_size) / frame_size)
+    return (window / window.sum()).astype(np.float32)
+
+
+@functools.lru_cache()
+def stft_frame_indices(num_samples, frame_size, hop_size, pad_end):
+    """Sample indices for each frame, and the zero-padding needed for the last frame."""
+    if pad_end:
+        num_frames = -(-num_samples // hop_size)
+    else:
+        num_frames = 1 + (num_samples - frame_size) // hop_size
+    padding = max((num_frames - 1) * hop_size + frame_size - num_samples, 0)
+    indices = np.arange(num_frames)[:, None] * hop_size + np.arange(frame_size)
+    return indices, padding
+
+
+# Port of https://github.com/magenta/ddsp/blob/master/ddsp/spectral_ops.py#L33
+# Windows and frame indices are computed once per shape, and embedded as constants when traced.
+# Returns complex frequency bins with shape `audio.shape[:-1] + (frames, frame_size // 2 + 1)`.
 # Note: keep an eye out for jax to implement this in
 # [jax.scipy.signal](https://jax.readthedocs.io/en/latest/jax.scipy.html#module-jax.scipy.signal)
-def stft(audio, sample_rate=16000, frame_size=2048, overlap=0.75, pad_end=True):
+def stft(
+    audio, sample_rate=DEFAULT_SAMPLE_RATE, frame_size=2048, overlap=0.75, pad_end=True
+):
     assert frame_size * overlap % 2.0 == 0.0
 
-    return jax_spectral.spectral.stft(
-        audio,
-        # sample_rate, # TODO need this
-        nperseg=int(frame_size),
-        noverlap=int(overlap),
-        # nfft=int(frame_size),
-        padded=pad_end,
+    frame_size = int(frame_size)
+    hop_size = frame_size - int(frame_size * overlap)
+    indices, padding = stft_frame_indices(
+        audio.shape[-1], frame_size, hop_size, pad_end
     )
+    audio = jnp.pad(audio, [(0, 0)] * (audio.ndim - 1) + [(0, padding)])
+    return jnp.fft.rfft(audio[..., indices] * stft_window(frame_size), axis=-1)
 
 
 # Port of https://github.com/magenta/ddsp/blob/master/ddsp/spectral_ops.py#L76
 def magnitute_spectrogram(audio, size=2048, overlap=0.75, pad_end=True):
-    return jnp.abs(stft(audio, frame_size=size, overlap=overlap, pad_end=pad_end)[2])
+    return jnp.abs(stft(audio, frame_size=size, overlap=overlap, pad_end=pad_end))
+
+
+def magnitude_spectrograms(audios, size=2048):
+    """Magnitude spectrograms of each of `audios` (which must have the same number of samples),
+    computed with a single STFT."""
+    flattened = [audio.reshape(-1, audio.shape[-1]) for audio in audios]
+    magnitudes = magnitute_spectrogram(jnp.concatenate(flattened), size=size)
+    split_indices = np.cumsum([audio.shape[0] for audio in flattened])[:-1]
+    return [
+        magnitude.reshape(audio.shape[:-1] + magnitude.shape[-2:])
+        for audio, magnitude in zip(audios, jnp.split(magnitudes, split_indices))
+    ]
 
 
 def safe_log(X, eps=1e-5):
@@ -50,45 +86,29 @@ def distance(X, Y, kind="L1"):
 # Spectral losses based on https://github.com/magenta/ddsp/blob/master/ddsp/losses.py#L132
 # Doesn't support `loudness` from original ddsp.
 # ddsp also has lots more experimental losses (that are worth investigating at some point!)
-loss_fn_for_label = {
-    # Compare raw samples (time domain).
-    "sample": lambda X, Y, distance_type: distance(X, Y, distance_type),
+# Each frequency loss compares a feature of the magnitude spectrograms (with shape `(..., frames, bins)`),
+# so that target features can be computed once and compared against any number of estimates.
+feature_fn_for_label = {
     # Compare linear magnitudes of spectrograms.
     # Core audio similarity loss. More sensitive to peak magnitudes than log magnitudes.
-    "magnitude": lambda X_mag, Y_mag, distance_type: distance(
-        X_mag, Y_mag, distance_type
-    ),
+    "magnitude": lambda mag: mag,
     # Compare log magnitudes of spectrograms.
     # Core audio similarity loss. More sensitive to quiet magnitudes than linear magnitudes.
-    "log_magnitude": lambda X_mag, Y_mag, distance_type: distance(
-        safe_log(X_mag), safe_log(Y_mag), distance_type
-    ),
+    "log_magnitude": lambda mag: safe_log(mag),
     # Compare the first finite difference of spectrograms in time.
     # Emphasizes changes of magnitude in time, such as at transients.
-    "delta_time": lambda X_mag, Y_mag, distance_type: distance(
-        jnp.diff(X_mag, axis=1), jnp.diff(Y_mag, axis=1), distance_type
-    ),
+    "delta_time": lambda mag: jnp.diff(mag, axis=-2),
     # Compare the first finite difference of spectrograms in frequency.
     # Emphasizes changes of magnitude in frequency, such as at the boundaries of a stack of harmonics.
-    "delta_freq": lambda X_mag, Y_mag, distance_type: distance(
-        jnp.diff(X_mag, axis=2), jnp.diff(Y_mag, axis=2), distance_type
-    ),
+    "delta_freq": lambda mag: jnp.diff(mag, axis=-1),
     # Compare the cumulative sum of spectrograms across frequency for each slice in time.
     # Similar to a 1-D Wasserstein loss.
     # This hopefully provides a non-vanishing gradient to push two non-overlapping sinusoids towards each other.
-    "cumsum_freq": lambda X_mag, Y_mag, distance_type: distance(
-        jnp.cumsum(X_mag, axis=2), jnp.cumsum(Y_mag, axis=2), distance_type
-    ),
+    "cumsum_freq": lambda mag: jnp.cumsum(mag, axis=-1),
 }
 
 sample_loss_labels = ["sample"]
-frequency_loss_labels = [
-    "magnitude",
-    "log_magnitude",
-    "delta_time",
-    "delta_freq",
-    "cumsum_freq",
-]
+frequency_loss_labels = list(feature_fn_for_label.keys())
 
 
 class LossOptions:
@@ -108,13 +128,12 @@ class LossOptions:
         },
         # Note: removing smaller fft sizes seems to get rid of some small non-convex "bumps"
         # in the loss curve for a sine wave with a target frequency param.
-        # Also, removing 2048 size since it's just so darn slow.
         # fft_sizes=(2048, 1024, 512, 256, 128, 64),
-        fft_sizes=(1024, 512, 256, 128),
+        fft_sizes=(2048, 1024, 512, 256, 128),
     ):
         """Args:
         weights: Dict of loss labels to relative weighting of that loss.
-            (See `loss_fn_for_label` above for details on loss types.)
+            (See `feature_fn_for_label` above for details on frequency loss types.)
         fft_sizes: Compare spectrograms at each of this list of fft sizes.
             Each spectrogram has a time-frequency resolution trade-off based on fft size,
             so comparing multiple scales allows multiple resolutions.
@@ -136,6 +155,22 @@ class LossOptions:
             if weight and weight > 0 and label in frequency_loss_labels
         ]
 
+    def key(self):
+        """Hashable summary of everything that affects the loss computation."""
+        return (
+            tuple(self.sample_weights),
+            tuple(self.frequency_weights),
+            self.sample_distance_type,
+            self.frequency_distance_type,
+            tuple(self.fft_sizes),
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, LossOptions) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
     def serialize(self):
         return {
             # Every key should be present in serialized options.
@@ -155,26 +190,61 @@ class LossOptions:
         }
 
 
-def loss_fn(X, Y, opts):
+def spectral_features(magnitudes, opts):
+    """Features of each fft size's magnitude spectrogram, for each frequency loss in `opts`."""
+    return {
+        fft_size: {
+            label: feature_fn_for_label[label](magnitude)
+            for label, _ in opts.frequency_weights
+        }
+        for fft_size, magnitude in zip(opts.fft_sizes, magnitudes)
+    }
+
+
+def target_features(Y, opts):
+    """Spectral features of a target, which can be passed to `loss_fn` for any number of estimates
+    to avoid recomputing them."""
+    if len(opts.frequency_weights) == 0:
+        return {}
+    return spectral_features(
+        [magnitude_spectrograms([Y], size)[0] for size in opts.fft_sizes], opts
+    )
+
+
+def loss_and_target_features(X, Y, opts, Y_features=None):
+    """Returns the loss between estimate `X` and target `Y`, along with the target's spectral features.
+    If `Y_features` are not provided, estimate and target spectrograms are computed together,
+    with a single STFT for each fft size."""
     loss = sum(
-        weight * loss_fn_for_label[label](X, Y, opts.sample_distance_type)
-        for label, weight in opts.sample_weights
+        weight * distance(X, Y, opts.sample_distance_type)
+        for _, weight in opts.sample_weights
     )
-    if len(opts.frequency_weights) > 0:
-        for fft_size in opts.fft_sizes:
-            # TODO janky. Should have the same dimension reqs for time & freq
-            if len(X.shape) == 1:
-                X = jnp.expand_dims(X, 0)
-            if len(Y.shape) == 1:
-                Y = jnp.expand_dims(Y, 0)
-            X_mag = magnitute_spectrogram(X, size=fft_size)
-            Y_mag = magnitute_spectrogram(Y, size=fft_size)
-            loss += sum(
-                weight
-                * loss_fn_for_label[label](X_mag, Y_mag, opts.frequency_distance_type)
-                for label, weight in opts.frequency_weights
+    if len(opts.frequency_weights) == 0:
+        return loss, {}
+
+    if Y_features is None:
+        X_magnitudes, Y_magnitudes = zip(
+            *[magnitude_spectrograms([X, Y], size) for size in opts.fft_sizes]
+        )
+        Y_features = spectral_features(Y_magnitudes, opts)
+    else:
+        X_magnitudes = [magnitude_spectrograms([X], size)[0] for size in opts.fft_sizes]
+    X_features = spectral_features(X_magnitudes, opts)
+    for fft_size in opts.fft_sizes:
+        loss += sum(
+            weight
+            * distance(
+                X_features[fft_size][label],
+                Y_features[fft_size][label],
+                opts.frequency_distance_type,
             )
-    return loss
+            for label, weight in opts.frequency_weights
+        )
+    return loss, Y_features
+
+
+def loss_fn(X, Y, opts, Y_features=None):
+    return loss_and_target_features(X, Y, opts, Y_features)[0]
 
 
 def correlation(X, Y):
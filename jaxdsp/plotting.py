@@ -105,30 +105,23 @@ def plot_optimization(
     a range of different initial values.
     `params_inits` should be a list of dicts - one for each parameter tree to initialize with
     `params_target` should be a single target params dict
+    All initial values are optimized in parallel, with a `training.PopulationTrainer`.
     """
 
-    params_estimated = {key: [] for key in params_target.keys()}
-    initial_losses = []
-    losses = []
     x = [
         param_init[varying_param_name] for param_init in params_inits
     ]  # TODO only pass in one to vary
-    for params_init in params_inits:
-        trainer = training.IterativeTrainer(
-            processor,
-            training.Config(),
-            processor.state_init(),
-            params_init,
-            track_history=True,
-        )
-        for i in range(steps):
-            X = Xs[i % Xs.shape[0]]
-            carry_target, Y_target = processor.tick_buffer(carry_target, X)
-            trainer.step(X, Y_target)
-        for key, param_estimated in params_estimated_i[processor.NAME].items():
-            params_estimated[key].append(param_estimated)
-        initial_losses.append(loss_history[0])
-        losses.append(loss_history[-1])
+    carry_target = {"params": params_target, "state": processor.state_init()}
+    Xs_steps = [Xs[i % Xs.shape[0]] for i in range(steps)]
+    Y_targets = []
+    for X in Xs_steps:
+        carry_target, Y_target = processor.tick_buffer(carry_target, X)
+        Y_targets.append(Y_target)
+    trainer = training.PopulationTrainer(processor, params_inits)
+    loss_history = trainer.train(np.stack(Xs_steps), np.stack(Y_targets), steps)
+    params_estimated = trainer.current_params
+    initial_losses = loss_history[:, 0]
+    losses = loss_history[:, -1]
     _, axes = plt.subplots(len(params_target) + 2, 1, figsize=(14, 12))
     for param_i, (label, param_target) in enumerate(params_target.items()):
         estimated_params_plot = axes[param_i]
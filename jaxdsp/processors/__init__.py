@@ -1,3 +1,9 @@
+from functools import lru_cache
+
+import jax.numpy as jnp
+from jax import jit, vmap
+from jax.tree_util import tree_map
+
 from jaxdsp.processors import (
     allpass_filter,
     clip,
@@ -5,6 +11,7 @@ from jaxdsp.processors import (
     feedforward_delay,
     fir_filter,
     freeverb,
+    gain,
     iir_filter,
     lowpass_feedback_comb_filter,
     sine_wave,
@@ -17,6 +24,7 @@ all_processors = [
     feedforward_delay,
     fir_filter,
     freeverb,
+    gain,
     iir_filter,
     lowpass_feedback_comb_filter,
     sine_wave,
@@ -26,13 +34,181 @@ empty_carry = {"state": None, "params": None}
 
 
 def is_nested_processor(processor):
-    return processor.NAME == "Serial Processors"
+    from jaxdsp.processors import processor_graph, serial_processors
+
+    return processor.NAME in (serial_processors.NAME, processor_graph.NAME)
+
+
+def is_processor_graph(processor):
+    from jaxdsp.processors import processor_graph
+
+    return processor.NAME == processor_graph.NAME
+
+
+def processor_for_node_key(node_key):
+    """Inner processors of nested processors are keyed by processor name, optionally followed by `#` and a suffix
+    to distinguish instances of the same processor (e.g. "Delay Line#2")."""
+    return processor_by_name.get(node_key.split("#")[0])
+
+
+def is_multichannel_processor(processor):
+    """Multichannel processors (e.g. Freeverb) process all channels of a `(channels, samples)` buffer together."""
+    return hasattr(processor, "tick_buffer_multichannel")
+
+
+def multichannel_state(processor, state, num_channels):
+    """Processor state for `tick_buffer_multichannel`, from the state returned by `state_init`.
+    Processors that aren't multichannel get a copy of their state for each channel."""
+    if is_nested_processor(processor):
+        return {
+            name: multichannel_state(
+                processor_for_node_key(name), inner_state, num_channels
+            )
+            for name, inner_state in state.items()
+        }
+    if is_multichannel_processor(processor):
+        return state
+    return tree_map(
+        lambda leaf: jnp.broadcast_to(leaf, (num_channels,) + jnp.shape(leaf)), state
+    )
+
+
+def has_tick(processor):
+    """Whether the processor implements a per-sample `tick` (all processors implement `tick_buffer`)."""
+    return getattr(processor, "HAS_TICK", True)
+
+
+def is_segmentable(processor, processor_state=None):
+    """Whether processing consecutive segments of a buffer gives the same result as processing it whole,
+    which holds for processors that carry everything they need across buffers in their state.
+    Processors that don't set `SEGMENTABLE = False`."""
+    if is_nested_processor(processor):
+        return all(
+            is_segmentable(processor_for_node_key(name))
+            for name in processor_state.keys()
+        )
+    return getattr(processor, "SEGMENTABLE", True)
+
+
+def before_ticks(processor, carry):
+    """Processors can define `before_ticks(carry)` to set up their state for a buffer of `tick`s,
+    as their `tick_buffer` does before processing."""
+    if hasattr(processor, "before_ticks"):
+        return processor.before_ticks(carry)
+    return carry
+
+
+# Per-channel carries of processors that aren't multichannel have params shared across channels,
+# and state stacked along the first axis.
+channel_carry_axes = {"params": None, "state": 0}
+
+
+def tick_multichannel(processor, carry, x):
+    """`tick` for a single sample of each channel, with `x` of shape `(channels,)`."""
+    if is_multichannel_processor(processor):
+        return processor.tick(carry, x)
+    return vmap(
+        processor.tick,
+        in_axes=(channel_carry_axes, 0),
+        out_axes=(channel_carry_axes, 0),
+    )(carry, x)
+
+
+def before_ticks_multichannel(processor, carry):
+    if is_multichannel_processor(processor) or not hasattr(processor, "before_ticks"):
+        return before_ticks(processor, carry)
+    return vmap(
+        processor.before_ticks,
+        in_axes=(channel_carry_axes,),
+        out_axes=channel_carry_axes,
+    )(carry)
+
+
+@lru_cache(maxsize=None)
+def channel_vmapped_tick_buffer(processor):
+    return jit(
+        vmap(
+            processor.tick_buffer,
+            in_axes=(channel_carry_axes, 0),
+            out_axes=(channel_carry_axes, 0),
+        )
+    )
+
+
+def tick_buffer_multichannel(processor, carry, X, donate_state=False):
+    """Process a `(channels, samples)` buffer, returning a `(channels, samples)` buffer.
+    Processors that aren't multichannel are vmapped across channels, with the per-channel state
+    from `multichannel_state` and params shared across channels.
+    Nested processors are compiled into a single function,
+    which reuses the passed state for the returned state if `donate_state`."""
+    if is_processor_graph(processor):
+        return processor.tick_buffer_multichannel(carry, X, donate_state=donate_state)
+    if is_nested_processor(processor):
+        from jaxdsp.processors import serial_processors
+
+        return serial_processors.compiled_tick_buffer(
+            tuple(carry["state"].keys()),
+            multichannel=True,
+            donate_state=donate_state,
+            fuse_ticks=serial_processors.FUSE_TICKS,
+        )(carry, X)
+    if is_multichannel_processor(processor):
+        return processor.tick_buffer_multichannel(carry, X)
+    return channel_vmapped_tick_buffer(processor)(carry, X)
+
+
+def processor_key(processor, processor_state=None):
+    """Hashable identifier of a processor's structure, used to key compiled functions.
+    For nested processors, this includes the ordered names of the inner processors
+    (and for graphs, their connections)."""
+    if is_processor_graph(processor):
+        return processor.key()
+    if is_nested_processor(processor):
+        return (processor.NAME,) + tuple(processor_state.keys())
+    return processor.NAME
+
+
+def processor_for_key(key):
+    if isinstance(key, tuple):
+        from jaxdsp.processors import processor_graph, serial_processors
+
+        if key[0] == processor_graph.NAME:
+            return processor_graph.ProcessorGraph(*key[1:])
+        return serial_processors
+    return processor_by_name[key]
+
+
+def in_processor_order(key, values):
+    """Nested processor params or state, keyed in the order of the inner processors in `key`.
+    JAX transformations return dicts with sorted keys, reordering the chain."""
+    if isinstance(key, tuple):
+        from jaxdsp.processors import processor_graph
+
+        if key[0] == processor_graph.NAME:
+            return {node_key: values[node_key] for node_key, _ in key[1]}
+        return {name: values[name] for name in key[1:]}
+    return values
+
+
+def jit_nested_tick_buffer(key, tick_buffer, donate_state=False):
+    """Jit a nested processor's `tick_buffer(params, state, X) -> (state, Y)`,
+    returning a `tick_buffer(carry, X)` with the state in the order of the inner processors in `key`
+    (jit returns dicts with sorted keys).
+    If `donate_state`, the state passed in is reused for the returned state, and can't be used again.
+    Params are never donated, since they're often shared (e.g. array `Param` default values)."""
+    jitted_tick_buffer = jit(tick_buffer, donate_argnums=(1,) if donate_state else ())
+
+    def ordered_tick_buffer(carry, X):
+        state, Y = jitted_tick_buffer(carry["params"], carry["state"], X)
+        return {"params": carry["params"], "state": in_processor_order(key, state)}, Y
+
+    return ordered_tick_buffer
 
 
 def default_param_values(processor, processor_state=None):
     if is_nested_processor(processor):
         return {
-            processor_name: default_param_values(processor_by_name[processor_name])
+            processor_name: default_param_values(processor_for_node_key(processor_name))
             for processor_name in processor_state.keys()
         }
     return {param.name: param.default_value for param in processor.PARAMS}
@@ -42,8 +218,26 @@ def serialize_processor(processor, params=None):
     if not processor:
         return None
 
+    # Graphs are serialized in the same form as graph configs, with each node's processor and params.
+    if is_processor_graph(processor):
+        return {
+            "name": processor.NAME,
+            "nodes": [
+                {
+                    **serialize_processor(
+                        processor_for_node_key(node_key),
+                        params.get(node_key) if params else None,
+                    ),
+                    "key": node_key,
+                    "inputs": list(input_keys),
+                }
+                for node_key, input_keys in processor.nodes
+            ],
+            "outputs": list(processor.output_keys),
+        }
+
     if is_nested_processor(processor) and params:
-        return [serialize_processor(processor_by_name[inner_name], inner_params) for inner_name, inner_params in params.items()]
+        return [{**serialize_processor(processor_for_node_key(inner_name), inner_params), "key": inner_name} for inner_name, inner_params in params.items()]
 
     return {
         "name": processor.NAME,
@@ -60,8 +254,8 @@ def param_by_name(processor_name):
 
 def params_to_unit_scale(params, processor_name):
     return {
-        name: params_to_unit_scale(value, name)
-        if name in processor_by_name
+        name: params_to_unit_scale(value, processor_for_node_key(name).NAME)
+        if processor_for_node_key(name)
         else param_by_name(processor_name)[name].to_unit_scale(value)
         for name, value in params.items()
     }
@@ -69,8 +263,8 @@ def params_to_unit_scale(params, processor_name):
 
 def params_from_unit_scale(params, processor_name):
     return {
-        name: params_from_unit_scale(value, name)
-        if name in processor_by_name
+        name: params_from_unit_scale(value, processor_for_node_key(name).NAME)
+        if processor_for_node_key(name)
         else param_by_name(processor_name)[name].from_unit_scale(value)
         for name, value in params.items()
     }
@@ -2,14 +2,20 @@ import jax.numpy as jnp
 from jax import jit, lax
 from jax.ops import index_update
 
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
 from jaxdsp.param import Param
+from jaxdsp.processors.block import tick_chunks
 
 NAME = "Allpass Filter"
 PARAMS = [Param("feedback", 0.0)]
 PRESETS = {}
 
+# Buffers shorter than this are processed one sample at a time.
+# (See `lowpass_feedback_comb_filter.py` for details on chunked processing.)
+MIN_BLOCK_BUFFER_SIZE = 64
 
-def state_init(buffer_size=20):
+
+def state_init(buffer_size=20, sample_rate=DEFAULT_SAMPLE_RATE):
     return {
         "buffer": jnp.zeros(buffer_size),
         "buffer_index": 0,
@@ -32,6 +38,24 @@ def tick(carry, x):
     return carry, out
 
 
+def tick_chunk(carry, X):
+    """Process a chunk of samples no longer than the delay buffer."""
+    params = carry["params"]
+    state = carry["state"]
+
+    buffer_size = state["buffer"].size
+    buffer_positions = (state["buffer_index"] + jnp.arange(X.size)) % buffer_size
+    buffer_out = state["buffer"][buffer_positions]
+    state["buffer"] = index_update(
+        state["buffer"], buffer_positions, X + buffer_out * params["feedback"]
+    )
+    state["buffer_index"] = (state["buffer_index"] + X.size) % buffer_size
+    return carry, -X + buffer_out
+
+
 @jit
 def tick_buffer(carry, X):
-    return lax.scan(tick, carry, X)
+    buffer_size = carry["state"]["buffer"].size
+    if buffer_size < MIN_BLOCK_BUFFER_SIZE:
+        return lax.scan(tick, carry, X)
+    return tick_chunks(tick_chunk, carry, X, min(buffer_size, X.size))
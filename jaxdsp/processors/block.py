@@ -0,0 +1,31 @@
+import jax.numpy as jnp
+from jax import lax
+
+
+def tick_chunks(tick_chunk, carry, X, chunk_size, axis=0):
+    """Process `X` with `tick_chunk` in consecutive chunks of `chunk_size` samples,
+    carrying state between chunks, with a shorter final chunk if needed.
+    Samples are along `axis` of `X` and of the output, either the first (`0`) or last (`-1`).
+    """
+    num_samples = X.shape[axis]
+    num_chunks = num_samples // chunk_size
+    chunked_size = num_chunks * chunk_size
+    if axis == 0:
+        chunks = X[:chunked_size].reshape((num_chunks, chunk_size) + X.shape[1:])
+    else:
+        chunks = jnp.moveaxis(
+            X[..., :chunked_size].reshape(X.shape[:-1] + (num_chunks, chunk_size)),
+            -2,
+            0,
+        )
+    carry, Y = lax.scan(tick_chunk, carry, chunks)
+    if axis == 0:
+        Y = Y.reshape((-1,) + Y.shape[2:])
+    else:
+        Y = jnp.moveaxis(Y, 0, -2).reshape(Y.shape[1:-1] + (-1,))
+    if chunked_size < num_samples:
+        carry, Y_remainder = tick_chunk(
+            carry, X[chunked_size:] if axis == 0 else X[..., chunked_size:]
+        )
+        Y = jnp.concatenate([Y, Y_remainder], axis=axis)
+    return carry, Y
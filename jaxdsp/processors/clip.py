@@ -1,6 +1,7 @@
 import jax.numpy as jnp
 from jax import jit
 
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
 from jaxdsp.param import Param
 
 NAME = "Clip"
@@ -8,7 +9,7 @@ PARAMS = [Param("min", -1.0, -1.0, 1.0), Param("max", 1.0, -1.0, 1.0)]
 PRESETS = {}
 
 
-def state_init():
+def state_init(sample_rate=DEFAULT_SAMPLE_RATE):
     return {}
 
 
@@ -11,25 +11,28 @@
 
 
 import jax.numpy as jnp
-import numpy as np
-from jax import jit, lax
+from jax import jit
 from jax.ops import index, index_update
 
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
 from jaxdsp.param import Param
 
-MAX_DELAY_LENGTH_SAMPLES = 44100
+# The `delay_samples` range covers this much delay at the default sample rate.
+# At other rates, `delay_samples` is clipped to `max_delay_seconds` of samples by the state.
+MAX_DELAY_SECONDS = 1.0
 
 NAME = "Delay Line"
 PARAMS = [
     Param("wet", 1.0),
-    Param("delay_samples", 0.9, 0.0, float(MAX_DELAY_LENGTH_SAMPLES)),
+    Param("delay_samples", 0.9, 0.0, DEFAULT_SAMPLE_RATE * MAX_DELAY_SECONDS),
 ]
 PRESETS = {}
 
 
-def state_init():
+# The delay line holds `max_delay_seconds` of audio, and `delay_samples` is clipped to its size.
+def state_init(sample_rate=DEFAULT_SAMPLE_RATE, max_delay_seconds=MAX_DELAY_SECONDS):
     return {
-        "delay_line": jnp.zeros(MAX_DELAY_LENGTH_SAMPLES),
+        "delay_line": jnp.zeros(int(sample_rate * max_delay_seconds)),
         "read_sample": 0.0,
         "write_sample": 0.0,
     }
@@ -39,6 +42,7 @@ def state_init():
 def tick(carry, x):
     params = carry["params"]
     state = carry["state"]
+    delay_line_size = state["delay_line"].size
 
     write_sample = state["write_sample"]
     read_sample = state["read_sample"]
@@ -50,25 +54,73 @@ def tick(carry, x):
     read_sample_floor = read_sample.astype("int32")
     interp = read_sample - read_sample_floor
     y = (1 - interp) * state["delay_line"][read_sample_floor]
-    y += (interp) * state["delay_line"][
-        (read_sample_floor + 1) % MAX_DELAY_LENGTH_SAMPLES
-    ]
+    y += (interp) * state["delay_line"][(read_sample_floor + 1) % delay_line_size]
 
     state["write_sample"] += 1
-    state["write_sample"] %= MAX_DELAY_LENGTH_SAMPLES
+    state["write_sample"] %= delay_line_size
     state["read_sample"] += 1
-    state["read_sample"] %= MAX_DELAY_LENGTH_SAMPLES
+    state["read_sample"] %= delay_line_size
 
     out = x * (1 - params["wet"]) + y * params["wet"]
     return carry, out
 
 
+# Sets the read position for `delay_samples` behind the write position,
+# before processing a buffer with `tick`s.
+def before_ticks(carry):
+    state = carry["state"]
+    delay_line_size = state["delay_line"].size
+    state["read_sample"] = (
+        state["write_sample"]
+        - jnp.clip(carry["params"]["delay_samples"], 0, delay_line_size)
+    ) % delay_line_size
+    return carry
+
+
+# Processes the whole buffer at once, with the same results as running `tick` for each sample:
+# each output sample reads from the samples written so far in this buffer,
+# falling back to the delay line for samples written before this buffer.
+# Only the positions being read and written are touched, rather than the whole delay line.
 @jit
 def tick_buffer(carry, X):
+    carry = before_ticks(carry)
     state = carry["state"]
     params = carry["params"]
-    state["read_sample"] = (
-        state["write_sample"]
-        - jnp.clip(params["delay_samples"], 0, MAX_DELAY_LENGTH_SAMPLES)
-    ) % MAX_DELAY_LENGTH_SAMPLES
-    return lax.scan(tick, carry, X)
+    delay_line = state["delay_line"]
+    delay_line_size = delay_line.size
+
+    sample_indices = jnp.arange(X.size)
+    write_sample = state["write_sample"].astype("int32")
+    # The integer and fractional parts of the read position are computed separately, since float32
+    # can't precisely represent fractional positions near the end of the delay line.
+    delay_samples = jnp.clip(params["delay_samples"], 0, delay_line_size)
+    delay_samples_ceil = jnp.ceil(delay_samples)
+    read_sample_floor = (
+        write_sample - delay_samples_ceil.astype("int32")
+    ) % delay_line_size
+    interp = delay_samples_ceil - delay_samples
+
+    def read(positions):
+        # Index into `X` of the most recent write to each position (negative if before this buffer).
+        X_indices = sample_indices - (
+            (write_sample + sample_indices - positions) % delay_line_size
+        )
+        return jnp.where(
+            X_indices >= 0, X[jnp.maximum(X_indices, 0)], delay_line[positions]
+        )
+
+    read_positions = (read_sample_floor + sample_indices) % delay_line_size
+    Y = (1 - interp) * read(read_positions)
+    Y += interp * read((read_positions + 1) % delay_line_size)
+
+    num_written = min(X.size, delay_line_size)
+    state["delay_line"] = index_update(
+        delay_line,
+        (write_sample + X.size - num_written + jnp.arange(num_written))
+        % delay_line_size,
+        X[X.size - num_written :],
+    )
+    state["write_sample"] = (state["write_sample"] + X.size) % delay_line_size
+    state["read_sample"] = (state["read_sample"] + X.size) % delay_line_size
+
+    return carry, X * (1 - params["wet"]) + Y * params["wet"]
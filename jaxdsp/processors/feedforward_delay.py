@@ -4,30 +4,41 @@ import numpy as np
 import jax.numpy as jnp
 from jax import jit
 
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
 from jaxdsp.param import Param
 
-MAX_DELAY_SIZE_SAMPLES = 44100
+# Bounds the `delay_samples` param range (at the default sample rate), and the delay by default.
+MAX_DELAY_SECONDS = 1.0
 
 NAME = "Feedforward Delay"
 PARAMS = [
     Param("wet", 1.0),
-    Param("delay_samples", 6.5, 0.0, float(MAX_DELAY_SIZE_SAMPLES)),
+    Param("delay_samples", 6.5, 0.0, DEFAULT_SAMPLE_RATE * MAX_DELAY_SECONDS),
 ]
 PRESETS = {}
+# Only `tick_buffer` is implemented.
+HAS_TICK = False
+# Inputs from previous buffers aren't kept, so the first `delay_samples` of each buffer are silent.
+SEGMENTABLE = False
 
 
-def state_init():
-    return {}
+# `delay_samples` is clipped to `max_delay_seconds`.
+def state_init(sample_rate=DEFAULT_SAMPLE_RATE, max_delay_seconds=MAX_DELAY_SECONDS):
+    return {"max_delay_samples": float(int(sample_rate * max_delay_seconds))}
 
 
 def tick(carry, x):
-    raise "single-sample tick method not implemented for feedforward_delay"
+    raise NotImplementedError(
+        "single-sample tick method not implemented for feedforward_delay"
+    )
 
 
 @jit
 def tick_buffer(carry, X):
     params = carry["params"]
-    delay_samples = params["delay_samples"]
+    delay_samples = jnp.clip(
+        params["delay_samples"], 0.0, carry["state"]["max_delay_samples"]
+    )
     remainder = delay_samples - jnp.floor(delay_samples)
     X_linear_interp = (1 - remainder) * X + remainder * jnp.concatenate(
         [jnp.array([0]), X[: X.size - 1]]
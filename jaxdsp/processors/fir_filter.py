@@ -1,6 +1,8 @@
+import numpy as np
 import jax.numpy as jnp
 from jax import jit, lax
 
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
 from jaxdsp.param import Param
 
 NAME = "FIR Filter"
@@ -8,25 +10,98 @@ NAME = "FIR Filter"
 PARAMS = [Param("B", jnp.concatenate([jnp.array([1.0]), jnp.zeros(4)]))]
 PRESETS = {}
 
+# Kernels at least this long are convolved using FFTs (overlap-save) rather than directly.
+FFT_CONVOLUTION_MIN_KERNEL_SIZE = 64
+# Kernels at least this long (e.g. measured impulse responses) are split into partitions of
+# `CONVOLUTION_PARTITION_SIZE` samples, which are all convolved at once with smaller FFTs.
+PARTITIONED_CONVOLUTION_MIN_KERNEL_SIZE = 16_384
+CONVOLUTION_PARTITION_SIZE = 4096
 
-def state_init(length=4):
+
+# `length` is the number of previous inputs carried between buffers,
+# which must be at least one less than the kernel size for consecutive buffers to be continuous.
+# Defaults to the size needed by the default kernel.
+def state_init(length=None, sample_rate=DEFAULT_SAMPLE_RATE):
+    if length is None:
+        length = PARAMS[0].default_value.size - 1
     return {"inputs": jnp.zeros(length)}
 
 
+def check_state_length(state, B):
+    # Shapes are static, so this raises when tracing rather than silently dropping history.
+    if state["inputs"].size < B.size - 1:
+        raise ValueError(
+            f"FIR filter state carries {state['inputs'].size} previous inputs, "
+            f"but a kernel of size {B.size} needs {B.size - 1}. "
+            f"Use `state_init(length={B.size - 1})`."
+        )
+
+
+def next_power_of_2(n):
+    return 1 << (int(n) - 1).bit_length()
+
+
+def previous_inputs(inputs, size):
+    """The `size` most recent carried inputs in chronological order, zero-padded if fewer are carried."""
+    inputs = jnp.flip(inputs[:size])
+    return jnp.concatenate([jnp.zeros(size - inputs.size), inputs])
+
+
+def fft_convolve(X, B):
+    """Equivalent to `jnp.convolve(X, B, mode="valid")`.
+    Circular convolution only wraps around into the (discarded) first `B.size - 1` samples.
+    """
+    fft_size = next_power_of_2(X.size)
+    return jnp.fft.irfft(
+        jnp.fft.rfft(X, fft_size) * jnp.fft.rfft(B, fft_size), fft_size
+    )[B.size - 1 : X.size]
+
+
+def partitioned_fft_convolve(X, B, partition_size=CONVOLUTION_PARTITION_SIZE):
+    """Equivalent to `jnp.convolve(X, B, mode="valid")`, with `B` split into partitions
+    which are convolved with their corresponding (overlapping) segments of `X` in the frequency domain.
+    The FFT size depends only on the partition size and the output size, not the kernel size.
+    """
+    num_partitions = -(-B.size // partition_size)
+    padding = num_partitions * partition_size - B.size
+    B_partitions = jnp.pad(B, (0, padding)).reshape(num_partitions, partition_size)
+    X = jnp.concatenate([jnp.zeros(padding), X])
+    output_size = X.size - num_partitions * partition_size + 1
+    segment_size = output_size + partition_size - 1
+    # Partition `q` of the kernel applies to the segment of input delayed by `q` partitions.
+    segment_starts = (num_partitions - 1 - np.arange(num_partitions)) * partition_size
+    X_segments = X[segment_starts[:, None] + np.arange(segment_size)[None, :]]
+    fft_size = next_power_of_2(segment_size)
+    Y_spectrum = (
+        jnp.fft.rfft(X_segments, fft_size) * jnp.fft.rfft(B_partitions, fft_size)
+    ).sum(axis=0)
+    return jnp.fft.irfft(Y_spectrum, fft_size)[partition_size - 1 : segment_size]
+
+
 @jit
 def tick(carry, x):
     state = carry["state"]
     params = carry["params"]
     B = params["B"]
-    state["inputs"] = jnp.concatenate([jnp.array([x]), state["inputs"][0:-1]])
-    y = B @ state["inputs"]
+    check_state_length(state, B)
+    inputs = jnp.concatenate([jnp.array([x]), state["inputs"]])
+    state["inputs"] = inputs[:-1]
+    y = B @ jnp.flip(previous_inputs(inputs, B.size))
     return carry, y
 
 
 @jit
 def tick_buffer(carry, X):
+    state = carry["state"]
     params = carry["params"]
     B = params["B"]
-    return carry, jnp.convolve(X, B)[: -(B.size - 1)]
-    # Impossibly, the following seems to perform about the exact same or even faster for large N?! O_O
-    # return lax.scan(tick, carry, X)[1]
+    check_state_length(state, B)
+    X_extended = jnp.concatenate([previous_inputs(state["inputs"], B.size - 1), X])
+    state["inputs"] = jnp.flip(
+        jnp.concatenate([jnp.flip(state["inputs"]), X])[X.size :]
+    )
+    if B.size >= PARTITIONED_CONVOLUTION_MIN_KERNEL_SIZE:
+        return carry, partitioned_fft_convolve(X_extended, B)
+    if B.size >= FFT_CONVOLUTION_MIN_KERNEL_SIZE:
+        return carry, fft_convolve(X_extended, B)
+    return carry, jnp.convolve(X_extended, B, mode="valid")
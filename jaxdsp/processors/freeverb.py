@@ -1,8 +1,9 @@
+import numpy as np
 import jax.numpy as jnp
 from jax import jit, lax
+from jax.ops import index, index_update
 
-from jaxdsp.processors import lowpass_feedback_comb_filter as comb
-from jaxdsp.processors import allpass_filter as allpass
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
 from jaxdsp.param import Param
 
 NAME = "Freeverb"
@@ -36,7 +37,10 @@ scale_dry = 2.0
 scale_damp = 0.4
 scale_room = 0.28
 offset_room = 0.7
+allpass_feedback = 0.5
 
+# Tunings are in samples at this sample rate, and are scaled to the sample rate given to `state_init`.
+tunings_sample_rate = 44100
 comb_tunings_l = [1116, 1188, 1277, 1356, 1422, 1491, 1557, 1617]
 allpass_tunings_l = [556, 441, 341, 225]
 stereo_spread = 23
@@ -45,58 +49,86 @@ stereo_spread = 23
 # allpass_tunings_l = [2, 3, 4, 5]
 
 
-def create_comb_carry(buffer_size):
+# Every comb (and every allpass) delay line is stored as a row in a single zero-padded array,
+# so that each bank is read and written with one vectorized gather/scatter per sample.
+def delay_bank_init(buffer_sizes):
+    buffer_sizes = np.asarray(buffer_sizes)
     return {
-        "state": comb.state_init(buffer_size=buffer_size),
-        "params": {"feedback": 0.5, "damp": 0.0},
+        "buffer": jnp.zeros(buffer_sizes.shape + (buffer_sizes.max(),)),
+        "buffer_size": jnp.asarray(buffer_sizes),
+        "buffer_index": jnp.zeros(buffer_sizes.shape, dtype="int32"),
     }
 
 
-def create_allpass_carry(buffer_size):
-    return {
-        "state": allpass.state_init(buffer_size=buffer_size),
-        "params": {"feedback": 0.5},
-    }
+def delay_bank_read(bank):
+    return jnp.take_along_axis(
+        bank["buffer"], jnp.expand_dims(bank["buffer_index"], -1), axis=-1
+    )[..., 0]
 
 
-def state_init():
-    return {
-        "combs_l": [create_comb_carry(buffer_size) for buffer_size in comb_tunings_l],
-        "combs_r": [
-            create_comb_carry(buffer_size + stereo_spread)
-            for buffer_size in comb_tunings_l
-        ],
-        "allpasses_l": [
-            create_allpass_carry(buffer_size) for buffer_size in allpass_tunings_l
-        ],
-        "allpasses_r": [
-            create_allpass_carry(buffer_size + stereo_spread)
-            for buffer_size in allpass_tunings_l
-        ],
-    }
+def delay_bank_write(bank, values):
+    """Write a sample to each delay line at its current index, and advance all indices."""
+    buffer = bank["buffer"]
+    rows = buffer.reshape(-1, buffer.shape[-1])
+    rows = index_update(
+        rows,
+        index[jnp.arange(rows.shape[0]), bank["buffer_index"].ravel()],
+        values.ravel(),
+    )
+    bank["buffer"] = rows.reshape(buffer.shape)
+    bank["buffer_index"] = (bank["buffer_index"] + 1) % bank["buffer_size"]
+    return bank
+
+
+def scaled_tunings(tunings_l, sample_rate):
+    scale = sample_rate / tunings_sample_rate
+    return [
+        [int(size * scale) for size in tunings_l],
+        [int((size + stereo_spread) * scale) for size in tunings_l],
+    ]
+
+
+def state_init(sample_rate=DEFAULT_SAMPLE_RATE):
+    comb_tunings = scaled_tunings(comb_tunings_l, sample_rate)
+    allpass_tunings = scaled_tunings(allpass_tunings_l, sample_rate)
+    # Leading axes are (channel, filter).
+    combs = delay_bank_init(comb_tunings)
+    combs["filter_store"] = jnp.zeros(combs["buffer_index"].shape)
+    return {"combs": combs, "allpasses": delay_bank_init(allpass_tunings)}
 
 
 @jit
 def tick(carry, x):
-    x_r, x_l = jnp.broadcast_to(x, (2,))  # handle stereo or mono in
+    x_l, x_r = jnp.broadcast_to(x, (2,))  # handle stereo or mono in
     x_combined = (x_l + x_r) * fixed_gain
 
     state = carry["state"]
     params = carry["params"]
 
-    out_l = 0.0
-    out_r = 0.0
+    room_size = (params["room_size"] * scale_room) + offset_room
+    damp = params["damp"] * scale_damp
 
-    # comb filters in parallel
-    for i in range(len(comb_tunings_l)):
-        state["combs_l"][i], out_comb_l = comb.tick(state["combs_l"][i], x_combined)
-        state["combs_r"][i], out_comb_r = comb.tick(state["combs_r"][i], x_combined)
-        out_l += out_comb_l
-        out_r += out_comb_r
-    # allpasses in series
-    for i in range(len(allpass_tunings_l)):
-        state["allpasses_l"][i], out_l = allpass.tick(state["allpasses_l"][i], out_l)
-        state["allpasses_r"][i], out_r = allpass.tick(state["allpasses_r"][i], out_r)
+    # Lowpass feedback comb filters in parallel
+    combs = state["combs"]
+    out_combs = delay_bank_read(combs)
+    combs["filter_store"] = out_combs * (1 - damp) + combs["filter_store"] * damp
+    state["combs"] = delay_bank_write(
+        combs, x_combined + combs["filter_store"] * room_size
+    )
+    out = out_combs.sum(axis=-1)
+
+    # Allpasses in series. Buffer reads don't depend on the input,
+    # so all reads and writes can still be done at once.
+    out_allpasses = delay_bank_read(state["allpasses"])
+    in_allpasses = []
+    for i in range(out_allpasses.shape[-1]):
+        in_allpasses.append(out)
+        out = -out + out_allpasses[:, i]
+    state["allpasses"] = delay_bank_write(
+        state["allpasses"],
+        jnp.stack(in_allpasses, axis=-1) + out_allpasses * allpass_feedback,
+    )
+    out_l, out_r = out
 
     wet = params["wet"] * scale_wet
     dry = params["dry"] * scale_dry
@@ -110,16 +142,11 @@ def tick(carry, x):
 
 @jit
 def tick_buffer(carry, X):
-    state = carry["state"]
-    params = carry["params"]
+    return lax.scan(tick, carry, X)
 
-    room_size = (params["room_size"] * scale_room) + offset_room
-    damp = params["damp"] * scale_damp
-    for comb_l in state["combs_l"]:
-        comb_l["params"]["feedback"] = room_size
-        comb_l["params"]["damp"] = damp
-    for comb_r in state["combs_r"]:
-        comb_r["params"]["feedback"] = room_size
-        comb_r["params"]["damp"] = damp
 
-    return lax.scan(tick, carry, X)
+@jit
+def tick_buffer_multichannel(carry, X):
+    """Process a `(channels, samples)` buffer of mono or stereo input, returning stereo output."""
+    carry, Y = lax.scan(tick, carry, X.T)
+    return carry, Y.T
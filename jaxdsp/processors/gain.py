@@ -0,0 +1,22 @@
+from jax import jit
+
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
+from jaxdsp.param import Param
+
+NAME = "Gain"
+PARAMS = [Param("gain", 1.0, 0.0, 2.0)]
+PRESETS = {}
+
+
+def state_init(sample_rate=DEFAULT_SAMPLE_RATE):
+    return {}
+
+
+@jit
+def tick(carry, x):
+    return carry, x * carry["params"]["gain"]
+
+
+@jit
+def tick_buffer(carry, X):
+    return tick(carry, X)
@@ -1,6 +1,9 @@
+import jax
 import jax.numpy as jnp
 from jax import jit, lax
+from jax.ops import index, index_add, index_update
 
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
 from jaxdsp.param import Param
 
 NAME = "IIR Filter"
@@ -10,9 +13,17 @@ PARAMS = [
     Param("A", jnp.concatenate([jnp.array([1.0]), jnp.zeros(4)])),
 ]
 PRESETS = {}
+# Buffers with at least this many samples are processed with `tick_buffer_parallel`,
+# and shorter ones with a sequential scan of `tick`s.
+# Sequential scans compile to tight loops on the CPU, where they outperform the parallel version
+# (for both processing and gradients) at any buffer size. On accelerators, each step of a sequential scan
+# is a separate kernel launch.
+# If `None`, the parallel version is used for all buffers unless the default backend is the CPU.
+# Set this before processing, since it's read when compiling.
+PARALLEL_MIN_BUFFER_SIZE = None
 
 
-def state_init(length=5):
+def state_init(length=5, sample_rate=DEFAULT_SAMPLE_RATE):
     return {
         "inputs": jnp.zeros(length),
         "outputs": jnp.zeros(length - 1),
@@ -36,6 +47,64 @@ def tick(carry, x):
     return carry, y
 
 
+def companion_matrix(a):
+    """State transition matrix for `y[n] = -a[0] * y[n - 1] - a[1] * y[n - 2] - ...`,
+    with state `[y[n], y[n - 1], ...]`."""
+    return jnp.concatenate([-jnp.expand_dims(a, 0), jnp.eye(a.size - 1, a.size)])
+
+
 @jit
-def tick_buffer(carry, X):
+def tick_buffer_parallel(carry, X):
+    """Equivalent to running `tick` over each sample, but evaluates the feedforward part with a single
+    convolution, and the recursive part as a linear state-space recurrence with a (logarithmic-depth)
+    associative scan."""
+    params = carry["params"]
+    state = carry["state"]
+    B = params["B"]
+    A = params["A"]
+
+    # Previous inputs are stored most-recent-first.
+    X_extended = jnp.concatenate([jnp.flip(state["inputs"][0:-1]), X])
+    state["inputs"] = jnp.flip(X_extended[-state["inputs"].size :])
+    Y = jnp.convolve(X_extended, B, mode="valid")
+    if state["outputs"].size > 0:
+        transition = companion_matrix(A[1:])
+        # Inputs to the state-space recurrence `s[n] = transition @ s[n - 1] + u[n]`.
+        U = index_update(jnp.zeros((X.size, state["outputs"].size)), index[:, 0], Y)
+        U = index_add(U, index[0], transition @ state["outputs"])
+        transitions = jnp.broadcast_to(transition, (X.size,) + transition.shape)
+
+        # Matrix products are written out as broadcasted sums,
+        # which is much faster than batched `matmul`s for these tiny matrices.
+        def combine(earlier, later):
+            earlier_transition, earlier_state = earlier
+            later_transition, later_state = later
+            return (
+                (
+                    later_transition[..., :, :, None]
+                    * earlier_transition[..., None, :, :]
+                ).sum(-2),
+                (later_transition * earlier_state[..., None, :]).sum(-1) + later_state,
+            )
+
+        _, states = lax.associative_scan(combine, (transitions, U))
+        state["outputs"] = states[-1]
+        Y = states[:, 0]
+    return carry, Y
+
+
+@jit
+def tick_buffer_sequential(carry, X):
     return lax.scan(tick, carry, X)
+
+
+def is_parallel(buffer_size):
+    if PARALLEL_MIN_BUFFER_SIZE is None:
+        return jax.default_backend() != "cpu"
+    return buffer_size >= PARALLEL_MIN_BUFFER_SIZE
+
+
+def tick_buffer(carry, X):
+    if is_parallel(X.size):
+        return tick_buffer_parallel(carry, X)
+    return tick_buffer_sequential(carry, X)
@@ -1,15 +1,22 @@
 import jax.numpy as jnp
 from jax import jit, lax
-from jax.ops import index_update
+from jax.ops import index_add, index_update
 
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
 from jaxdsp.param import Param
+from jaxdsp.processors.block import tick_chunks
 
 NAME = "Lowpass Feedback Comb Filter"
 PARAMS = [Param("feedback", 0.0), Param("damp", 0.0)]
 PRESETS = {}
 
+# Buffers shorter than this are processed one sample at a time.
+# Otherwise, buffers are processed in chunks of (at most) the delay length, which is enough
+# to compute all output samples of a chunk from the delay buffer with vectorized ops.
+MIN_BLOCK_BUFFER_SIZE = 64
 
-def state_init(buffer_size=20):
+
+def state_init(buffer_size=20, sample_rate=DEFAULT_SAMPLE_RATE):
     return {
         "buffer": jnp.zeros(buffer_size),
         "buffer_index": 0,
@@ -37,6 +44,39 @@ def tick(carry, x):
     return carry, out
 
 
+def one_pole(X, pole, y_init):
+    """`y[n] = X[n] + pole * y[n - 1]`, evaluated as a (logarithmic-depth) associative scan."""
+    coefficients = jnp.full(X.shape, pole)
+    X = index_add(X, 0, pole * y_init)
+    _, Y = lax.associative_scan(
+        lambda a, b: (a[0] * b[0], b[0] * a[1] + b[1]), (coefficients, X)
+    )
+    return Y
+
+
+def tick_chunk(carry, X):
+    """Process a chunk of samples no longer than the delay buffer.
+    Every output sample in the chunk was written to the buffer before the chunk started."""
+    params = carry["params"]
+    state = carry["state"]
+
+    buffer_size = state["buffer"].size
+    buffer_positions = (state["buffer_index"] + jnp.arange(X.size)) % buffer_size
+    out = state["buffer"][buffer_positions]
+    filter_store = one_pole(
+        out * (1 - params["damp"]), params["damp"], state["filter_store"]
+    )
+    state["filter_store"] = filter_store[-1]
+    state["buffer"] = index_update(
+        state["buffer"], buffer_positions, X + filter_store * params["feedback"]
+    )
+    state["buffer_index"] = (state["buffer_index"] + X.size) % buffer_size
+    return carry, out
+
+
 @jit
 def tick_buffer(carry, X):
-    return lax.scan(tick, carry, X)
+    buffer_size = carry["state"]["buffer"].size
+    if buffer_size < MIN_BLOCK_BUFFER_SIZE:
+        return lax.scan(tick, carry, X)
+    return tick_chunks(tick_chunk, carry, X, min(buffer_size, X.size))
@@ -1,26 +1,119 @@
-from jaxdsp.processors import processor_by_name
+from functools import lru_cache
+
+from jax import lax
+
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
+from jaxdsp.processors import (
+    processor_for_node_key,
+    jit_nested_tick_buffer,
+    has_tick,
+    before_ticks,
+    before_ticks_multichannel,
+    tick_multichannel,
+    tick_buffer_multichannel,
+)
 
 NAME = "Serial Processors"
 PARAMS = []
 PRESETS = {}
+# If set, runs of processors with a per-sample `tick` are processed with a single `lax.scan` over the buffer,
+# with each scan step running the sample through all their `tick`s, rather than each processor's `tick_buffer` in turn.
+# This walks the buffer once for the whole run, but gives up any block processing in the `tick_buffer`s.
+FUSE_TICKS = False
+
+
+def state_init(processors, sample_rate=DEFAULT_SAMPLE_RATE):
+    """`processors` can also include node keys (see `processor_for_node_key`),
+    to include the same processor more than once (e.g. "Delay Line#2")."""
+    node_keys = [
+        processor if isinstance(processor, str) else processor.NAME
+        for processor in processors
+    ]
+    return {
+        node_key: processor_for_node_key(node_key).state_init(sample_rate=sample_rate)
+        for node_key in node_keys
+    }
+
+
+def tick_runs(processor_names, fuse_ticks):
+    """Split the chain into runs of processor names to process together.
+    With `fuse_ticks`, consecutive processors with a `tick` are in the same run."""
+    runs = []
+    for processor_name in processor_names:
+        fusable = fuse_ticks and has_tick(processor_for_node_key(processor_name))
+        if fusable and runs and runs[-1][0]:
+            runs[-1][1].append(processor_name)
+        else:
+            runs.append((fusable, [processor_name]))
+    return [processor_names for _, processor_names in runs]
+
+
+def fused_ticks(processor_names, carries, X, multichannel=False):
+    """Process a buffer through the named processors with a single scan over samples."""
+    processors = [processor_for_node_key(name) for name in processor_names]
+    if multichannel:
+        carries = [
+            before_ticks_multichannel(processor, carry)
+            for processor, carry in zip(processors, carries)
+        ]
+    else:
+        carries = [
+            before_ticks(processor, carry)
+            for processor, carry in zip(processors, carries)
+        ]
+
+    def tick(carries, x):
+        next_carries = []
+        for processor, carry in zip(processors, carries):
+            if multichannel:
+                carry, x = tick_multichannel(processor, carry, x)
+            else:
+                carry, x = processor.tick(carry, x)
+            next_carries.append(carry)
+        return next_carries, x
+
+    if multichannel:
+        carries, Y = lax.scan(tick, carries, X.T)
+        return carries, Y.T
+    return lax.scan(tick, carries, X)
+
+
+@lru_cache(maxsize=None)
+def compiled_tick_buffer(
+    processor_names, multichannel=False, donate_state=False, fuse_ticks=False
+):
+    """A single jitted function processing a buffer through the named processors, in order,
+    so intermediate buffers stay on device.
+    See `jit_nested_tick_buffer` for `donate_state`, and `FUSE_TICKS` for `fuse_ticks`."""
+    key = (NAME,) + processor_names
+    runs = tick_runs(processor_names, fuse_ticks)
 
+    def tick_buffer(params, state, X):
+        Y = X
+        next_state = {}
+        for run in runs:
+            carries = [
+                {"state": state[processor_name], "params": params[processor_name]}
+                for processor_name in run
+            ]
+            if len(run) > 1:
+                carries, Y = fused_ticks(run, carries, Y, multichannel)
+            elif multichannel:
+                carries[0], Y = tick_buffer_multichannel(
+                    processor_for_node_key(run[0]), carries[0], Y
+                )
+            else:
+                carries[0], Y = processor_for_node_key(run[0]).tick_buffer(
+                    carries[0], Y
+                )
+            for processor_name, processor_carry in zip(run, carries):
+                next_state[processor_name] = processor_carry["state"]
+        return next_state, Y
 
-def state_init(processors):
-    return {processor.NAME: processor.state_init() for processor in processors}
+    return jit_nested_tick_buffer(key, tick_buffer, donate_state)
 
 
 def tick_buffer(carry, X):
-    state = carry["state"]
-    params = carry["params"]
-    Y = X
-    for processor_name in state.keys():
-        processor_carry = {
-            "state": state[processor_name],
-            "params": params[processor_name],
-        }
-        processor_carry, Y = processor_by_name[processor_name].tick_buffer(
-            processor_carry, Y
-        )
-        state[processor_name] = processor_carry["state"]
-        params[processor_name] = processor_carry["params"]
-    return carry, Y
+    return compiled_tick_buffer(tuple(carry["state"].keys()), fuse_ticks=FUSE_TICKS)(
+        carry, X
+    )
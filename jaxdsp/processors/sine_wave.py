@@ -1,6 +1,7 @@
 import jax.numpy as jnp
 from jax import jit
 
+from jaxdsp.constants import DEFAULT_SAMPLE_RATE
 from jaxdsp.param import Param
 
 NAME = "Sine Wave"
@@ -8,15 +9,17 @@ PARAMS = [
     Param("frequency_hz", 440.0, 55.0, 7_040, log_scale=True),
 ]
 PRESETS = {}
+# Only `tick_buffer` is implemented.
+HAS_TICK = False
 
 
-def state_init():
-    return {"phase_radians": 0.0, "sample_rate": 44100}
+def state_init(sample_rate=DEFAULT_SAMPLE_RATE):
+    return {"phase_radians": 0.0, "sample_rate": sample_rate}
 
 
 @jit
 def tick(carry, x):
-    raise "single-sample tick method not implemented for sine_wave"
+    raise NotImplementedError("single-sample tick method not implemented for sine_wave")
 
 
 @jit
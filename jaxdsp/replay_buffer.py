@@ -0,0 +1,89 @@
+import numpy as np
+from jax.tree_util import tree_flatten, tree_map, tree_multimap
+
+
+class ReplayBuffer:
+    """Fixed-capacity ring of training examples, for sampling minibatches.
+
+    Each example is a dict of (pytrees of) arrays, e.g. `{"X": X, "Y": Y}`.
+    Storage for `capacity` examples is allocated when the first example is added,
+    and the oldest examples are overwritten once the buffer is full.
+    Adding an example with a different structure or shape (e.g. after a buffer size change)
+    clears the buffer and reallocates.
+    """
+
+    def __init__(self, capacity, recency_half_life=None, seed=None):
+        """Args:
+        capacity: Maximum number of examples retained.
+        recency_half_life: If provided, sample more recent examples more often, with the probability
+            of sampling an example halving for every `recency_half_life` newer examples.
+            Otherwise, sample uniformly.
+        """
+        self.capacity = capacity
+        self.recency_half_life = recency_half_life
+        self.rng = np.random.default_rng(seed)
+        self.items = None
+        self.clear()
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        self.size = 0
+        self.next_index = 0
+
+    def allocate(self, example):
+        self.items = tree_map(lambda leaf: self.allocate_field(leaf), example)
+        self.clear()
+
+    def allocate_field(self, leaf):
+        return np.zeros((self.capacity,) + np.shape(leaf), dtype=np.asarray(leaf).dtype)
+
+    def matches(self, example):
+        if self.items is None:
+            return False
+
+        leaves, structure = tree_flatten(example)
+        item_leaves, item_structure = tree_flatten(self.items)
+        return structure == item_structure and all(
+            items.shape[1:] == np.shape(leaf)
+            for items, leaf in zip(item_leaves, leaves)
+        )
+
+    def add(self, example):
+        if not self.matches(example):
+            self.allocate(example)
+
+        def set_item(items, leaf):
+            items[self.next_index] = leaf
+
+        tree_multimap(set_item, self.items, example)
+        self.next_index = (self.next_index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def set_field(self, key, values):
+        """Replace the values of `key` for every stored example, e.g. with `values` recomputed from
+        another field (with leading dimension `capacity`)."""
+        self.items[key] = tree_map(np.asarray, values)
+
+    def sample_indices(self, batch_size):
+        if self.recency_half_life:
+            # Age 0 is the most recently added example.
+            ages = (self.next_index - 1 - np.arange(self.size)) % self.capacity
+            weights = 0.5 ** (ages / self.recency_half_life)
+            probabilities = weights / weights.sum()
+        else:
+            probabilities = None
+        return self.rng.choice(
+            self.size,
+            batch_size,
+            replace=batch_size > self.size,
+            p=probabilities,
+        )
+
+    def sample(self, batch_size):
+        """A minibatch of `batch_size` examples, stacked along the first axis.
+        Samples with replacement if fewer than `batch_size` examples are stored,
+        so that batches always have the same shape."""
+        indices = self.sample_indices(batch_size)
+        return tree_map(lambda items: items[indices], self.items)
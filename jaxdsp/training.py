@@ -1,15 +1,300 @@
+import functools
+
 import numpy as np
-from jax import grad, value_and_grad, jit
+import jax.numpy as jnp
+from jax import grad, value_and_grad, jit, vmap, checkpoint, lax
 from jax.tree_util import tree_map, tree_multimap
 
-from jaxdsp.processors import serial_processors, params_to_unit_scale, params_from_unit_scale, default_param_values
-from jaxdsp.loss import LossOptions, loss_fn
+from jaxdsp.processors import (
+    serial_processors,
+    params_to_unit_scale,
+    params_from_unit_scale,
+    default_param_values,
+    processor_key,
+    processor_for_key,
+    in_processor_order,
+    is_segmentable,
+    tick_buffer_multichannel,
+)
+from jaxdsp.processors.block import tick_chunks
+from jaxdsp.loss import LossOptions, loss_and_target_features, target_features
 from jaxdsp.optimizers import create_optimizer
 
+# Compiled gradient functions are shared across all trainers (and so across all server clients),
+# so that switching back to a previously used configuration doesn't trigger a recompile.
+# Least-recently-used functions (along with their compiled XLA executables) are evicted beyond this size.
+GRAD_FN_CACHE_SIZE = 32
+
 
 @jit
 def mean_loss_and_grads(loss, grads):
-    return np.mean(loss), tree_map(lambda grad: np.mean(grad, axis=0), grads)
+    return jnp.mean(loss), tree_map(lambda grad: jnp.mean(grad, axis=0), grads)
+
+
+def checkpointed_tick_buffer(tick_buffer, segment_size, sample_axis):
+    """Wrap `tick_buffer` to process buffers in segments of `segment_size` samples, rematerializing
+    each segment's intermediate values during the backward pass instead of storing them.
+    Only the carry between segments is kept: smaller segments trade more recompute for less memory.
+    `tick_buffer` must be segmentable (see `is_segmentable`)."""
+    tick_segment = checkpoint(tick_buffer)
+    return lambda carry, X: tick_chunks(
+        tick_segment, carry, X, min(segment_size, X.shape[sample_axis]), sample_axis
+    )
+
+
+def processor_loss(
+    processor_key,
+    loss_options,
+    multichannel,
+    checkpoint_segment_size,
+    unit_scale_params,
+    state,
+    X,
+    Y_target,
+    Y_target_features,
+):
+    processor = processor_for_key(processor_key)
+    params = params_from_unit_scale(unit_scale_params, processor.NAME)
+    # Nested processor state is passed in with sorted keys, so the processing order is restored from the key.
+    carry = {"params": params, "state": in_processor_order(processor_key, state)}
+
+    def tick_buffer(carry, X):
+        # `checkpoint` and `lax.scan` also pass dicts with sorted keys.
+        carry = {
+            "params": carry["params"],
+            "state": in_processor_order(processor_key, carry["state"]),
+        }
+        if multichannel:
+            return tick_buffer_multichannel(processor, carry, X)
+        return processor.tick_buffer(carry, X)
+
+    if checkpoint_segment_size and is_segmentable(processor, carry["state"]):
+        tick_buffer = checkpointed_tick_buffer(
+            tick_buffer, checkpoint_segment_size, -1 if multichannel else 0
+        )
+    elif checkpoint_segment_size:
+        # Segmenting would change the result, so rematerialize the whole buffer instead.
+        tick_buffer = checkpoint(tick_buffer)
+    carry, Y_estimated = tick_buffer(carry, X)
+    if not multichannel and Y_estimated.shape == Y_target.shape[::-1]:
+        Y_estimated = Y_estimated.T  # TODO should eventually remove this check
+    loss, Y_target_features = loss_and_target_features(
+        Y_estimated, Y_target, loss_options, Y_target_features
+    )
+    return loss, (carry["state"], Y_target_features)
+
+
+def window_loss(
+    processor_key,
+    loss_options,
+    multichannel,
+    checkpoint_segment_size,
+    unit_scale_params,
+    state,
+    Xs,
+    Y_targets,
+    Y_targets_features,
+):
+    """Mean `processor_loss` over a window of consecutive buffers (stacked along the first axis),
+    with the processor state chained from each buffer to the next, so gradients flow across buffers.
+    The initial `state` is not differentiated, which detaches the window from previous windows."""
+
+    def buffer_loss(state, inputs):
+        X, Y_target, Y_target_features = inputs
+        loss, (state, Y_target_features) = processor_loss(
+            processor_key,
+            loss_options,
+            multichannel,
+            checkpoint_segment_size,
+            unit_scale_params,
+            state,
+            X,
+            Y_target,
+            Y_target_features,
+        )
+        return state, (loss, Y_target_features)
+
+    state, (losses, Y_targets_features) = lax.scan(
+        buffer_loss, state, (Xs, Y_targets, Y_targets_features)
+    )
+    return jnp.mean(losses), (state, Y_targets_features)
+
+
+@functools.lru_cache(maxsize=GRAD_FN_CACHE_SIZE)
+def compiled_grad_fn(
+    processor_key,
+    loss_options,
+    multichannel,
+    checkpoint_segment_size,
+    batched,
+    X_shape,
+    Y_shape,
+    dtype,
+    windowed=False,
+):
+    """Returns a jitted `value_and_grad` of the processor loss, cached on everything that
+    determines its compiled program.
+    If `multichannel`, inputs and targets are `(channels, samples)` buffers, processed with
+    `tick_buffer_multichannel` (and the processor state is from `multichannel_state`).
+    If `checkpoint_segment_size` is set, the gradient is computed with segment-wise
+    rematerialization (see `checkpointed_tick_buffer`), bounding backward-pass memory for long buffers.
+    Processors that aren't segmentable are rematerialized as a whole buffer.
+    If `batched`, the returned function is vmapped over stacked states, inputs, targets and
+    target features, with params shared across the batch.
+    If `windowed`, inputs and targets are windows of consecutive buffers, with gradients of
+    `window_loss` (truncated backpropagation through time)."""
+    grad_fn = value_and_grad(
+        functools.partial(
+            window_loss if windowed else processor_loss,
+            processor_key,
+            loss_options,
+            multichannel,
+            checkpoint_segment_size,
+        ),
+        has_aux=True,
+    )
+    if batched:
+        grad_fn = vmap(grad_fn, in_axes=(None, 0, 0, 0, 0))
+    return jit(grad_fn)
+
+
+def optimize(
+    processor_key,
+    loss_options,
+    multichannel,
+    checkpoint_segment_size,
+    optimizer,
+    num_steps,
+    opt_state,
+    first_step_num,
+    state,
+    Xs,
+    Y_targets,
+    Y_targets_features,
+):
+    """Run `num_steps` optimizer steps from `opt_state` in a single `lax.scan`, cycling through
+    the buffers in `Xs` and `Y_targets` (stacked along the first axis), with the processor state
+    carried across steps.
+    `Y_targets_features` are the (stacked) target features of `Y_targets`, from `target_features`.
+    Returns the loss at each step, the unit scale params each loss was computed with, and the final
+    optimizer and processor states."""
+    grad_fn = value_and_grad(
+        functools.partial(
+            processor_loss,
+            processor_key,
+            loss_options,
+            multichannel,
+            checkpoint_segment_size,
+        ),
+        has_aux=True,
+    )
+    num_buffers = Xs.shape[0]
+
+    def step(carry, step):
+        opt_state, state = carry
+        step_num, i = step
+        params = optimizer.get_params(opt_state)
+        (loss, (state, _)), grads = grad_fn(
+            params,
+            state,
+            Xs[i],
+            Y_targets[i],
+            tree_map(lambda features: features[i], Y_targets_features),
+        )
+        return (optimizer.update(step_num, grads, opt_state), state), (loss, params)
+
+    step_indices = jnp.arange(num_steps)
+    (opt_state, state), (losses, params_history) = lax.scan(
+        step,
+        (opt_state, state),
+        (first_step_num + step_indices, step_indices % num_buffers),
+    )
+    return losses, params_history, opt_state, state
+
+
+@functools.lru_cache(maxsize=GRAD_FN_CACHE_SIZE)
+def compiled_optimize_fn(
+    processor_key,
+    loss_options,
+    multichannel,
+    checkpoint_segment_size,
+    optimizer_name,
+    optimizer_param_values,
+    num_steps,
+    Xs_shape,
+    Ys_shape,
+    dtype,
+):
+    """Returns a jitted `optimize` for the given configuration."""
+    return jit(
+        functools.partial(
+            optimize,
+            processor_key,
+            loss_options,
+            multichannel,
+            checkpoint_segment_size,
+            create_optimizer(optimizer_name, dict(optimizer_param_values)),
+            num_steps,
+        )
+    )
+
+
+@functools.lru_cache(maxsize=GRAD_FN_CACHE_SIZE)
+def compiled_population_optimize_fn(
+    processor_key,
+    loss_options,
+    multichannel,
+    optimizer_name,
+    optimizer_param_values,
+    num_steps,
+    Xs_shape,
+    Ys_shape,
+    dtype,
+):
+    """Returns a jitted `optimize`, vmapped over stacked initial params, with the processor state,
+    inputs and targets shared across the population.
+    Target features don't depend on the params, so they're computed once, outside the vmap."""
+    optimizer = create_optimizer(optimizer_name, dict(optimizer_param_values))
+
+    def optimize_member(unit_scale_params, state, Xs, Y_targets, Y_targets_features):
+        losses, params_history, opt_state, _ = optimize(
+            processor_key,
+            loss_options,
+            multichannel,
+            None,
+            optimizer,
+            num_steps,
+            optimizer.init(unit_scale_params),
+            0,
+            state,
+            Xs,
+            Y_targets,
+            Y_targets_features,
+        )
+        return losses, params_history, optimizer.get_params(opt_state)
+
+    def optimize_population(unit_scale_params, state, Xs, Y_targets):
+        return vmap(optimize_member, in_axes=(0, None, None, None, None))(
+            unit_scale_params,
+            state,
+            Xs,
+            Y_targets,
+            target_features(Y_targets, loss_options),
+        )
+
+    return jit(optimize_population)
+
+
+@functools.lru_cache(maxsize=GRAD_FN_CACHE_SIZE)
+def compiled_target_features_fn(loss_options):
+    return jit(functools.partial(target_features, opts=loss_options))
+
+
+def stack_states(state, batch_size):
+    """Broadcast a single processor state to `batch_size` per-example states."""
+    return tree_map(
+        lambda leaf: jnp.broadcast_to(leaf, (batch_size,) + jnp.shape(leaf)), state
+    )
 
 
 class LossHistoryAccumulator:
@@ -25,6 +310,15 @@ class LossHistoryAccumulator:
             self.params_history,
         )
 
+    def after_steps(self, losses, new_params):
+        """Record a run of steps, with `losses` and each param in `new_params` stacked by step."""
+        self.loss_history.extend(losses)
+        self.params_history = tree_multimap(
+            lambda new_params, params: params + list(new_params),
+            new_params,
+            self.params_history,
+        )
+
 
 def float_params(params):
     return tree_map(
@@ -44,9 +338,23 @@ class IterativeTrainer:
         processor_state=None,
         processor_params=None,
         track_history=False,
+        multichannel=False,
+        checkpoint_segment_size=None,
+        window_size=1,
     ):
+        self.multichannel = multichannel
+        # Number of consecutive buffers per truncated backpropagation-through-time window, for `step_stream`.
+        self.window_size = window_size
+        self.stream_window = []
+        # Number of samples per rematerialized segment in the backward pass. `None` stores everything.
+        self.checkpoint_segment_size = checkpoint_segment_size
         self.step_num = 0
         self.loss = 0.0
+        self.processor_key = None
+        self.batch_processor_states = None
+        # Spectral features of the most recent target, reused while the target (and loss options) are unchanged.
+        self.cached_features_key = None
+        self.cached_target_features = None
         self.track_history = track_history
         self.processor = processor
         self.current_params = processor_params
@@ -57,7 +365,9 @@ class IterativeTrainer:
     def set_processor(self, processor, params=None, state=None):
         self.processor = processor
         if processor:
+            self.stream_window = []
             self.processor_state = state or processor.state_init()
+            self.processor_key = processor_key(processor, self.processor_state)
             self.current_params = params or default_param_values(processor, self.processor_state)
             self.step_evaluator = LossHistoryAccumulator(self.current_params)
             self.opt_state = self.optimizer.init(
@@ -65,6 +375,7 @@ class IterativeTrainer:
             )
         else:
             self.processor_state = None
+            self.processor_key = None
             self.current_params = None
             self.step_evaluator = None
             self.opt_state = None
@@ -81,35 +392,171 @@ class IterativeTrainer:
             self.opt_state = self.optimizer.init(
                 params_to_unit_scale(self.current_params, self.processor.NAME)
             )
-        if self.processor:
-            self.processor_state = self.processor.state_init
 
     def set_loss_options(self, loss_options):
         self.loss_options = loss_options or LossOptions()
 
-        def processor_loss(unit_scale_params, state, X, Y_target):
-            params = params_from_unit_scale(unit_scale_params, self.processor.NAME)
-            carry, Y_estimated = self.processor.tick_buffer(
-                {"params": params, "state": state}, X
-            )
-            if Y_estimated.shape == Y_target.shape[::-1]:
-                Y_estimated = Y_estimated.T  # TODO should eventually remove this check
-            return (
-                loss_fn(Y_estimated, Y_target, self.loss_options),
-                carry["state"],
-            )
+    def grad_fn(self, X, Y_target, batched=False, windowed=False):
+        return compiled_grad_fn(
+            self.processor_key,
+            self.loss_options,
+            self.multichannel,
+            self.checkpoint_segment_size,
+            batched,
+            X.shape,
+            Y_target.shape,
+            X.dtype,
+            windowed,
+        )
 
-        # jit(vmap(value_and_grad(processor_loss), in_axes=(None, 0), out_axes=0))
-        self.grad_fn = jit(value_and_grad(processor_loss, has_aux=True))
+    def cached_features(self, Y_target):
+        cached_target, cached_loss_options = self.cached_features_key or (None, None)
+        if cached_target is Y_target and cached_loss_options == self.loss_options:
+            return self.cached_target_features
+        return None
 
-    def step(self, X, Y_target):
-        # loss, grads = mean_loss_and_grads(*grad_fn(get_params(opt_state), Xs_batch))
-        (self.loss, self.processor_state), self.grads = self.grad_fn(
+    def cache_features(self, Y_target, Y_target_features):
+        self.cached_features_key = (Y_target, self.loss_options)
+        self.cached_target_features = Y_target_features
+
+    def target_features(self, Y_target):
+        """Precompute the spectral features of a target for the current loss options,
+        to pass to `step` (or `step_batch`, if computed for stacked targets).
+        Features are ignored if the loss options have changed since they were computed."""
+        return self.loss_options, compiled_target_features_fn(self.loss_options)(
+            Y_target
+        )
+
+    def features_for(self, Y_target, Y_target_features=None):
+        if Y_target_features is not None:
+            loss_options, features = Y_target_features
+            if loss_options == self.loss_options:
+                return features
+        return self.cached_features(Y_target)
+
+    def step(self, X, Y_target, Y_target_features=None):
+        grad_fn = self.grad_fn(X, Y_target)
+        (self.loss, (processor_state, Y_target_features)), self.grads = grad_fn(
             params_to_unit_scale(self.current_params, self.processor.NAME),
             self.processor_state,
             X,
             Y_target,
+            self.features_for(Y_target, Y_target_features),
+        )
+        self.processor_state = in_processor_order(self.processor_key, processor_state)
+        self.cache_features(Y_target, Y_target_features)
+        self.apply_grads()
+
+    def step_batch(
+        self, Xs, Y_targets, processor_states=None, Y_targets_features=None
+    ):
+        """Take a single optimizer step using the mean loss and gradients over a batch.
+
+        Args:
+            Xs: Input buffers stacked along the first axis.
+            Y_targets: Target buffers stacked along the first axis.
+            processor_states: Per-example processor states, with each leaf stacked along
+                the first axis. Defaults to the trainer's current processor state,
+                broadcast across the batch.
+            Y_targets_features: Optional precomputed (stacked) target features, from `target_features`.
+        Returns the per-example processor states after processing each buffer.
+        """
+        if processor_states is None:
+            processor_states = stack_states(self.processor_state, len(Xs))
+        grad_fn = self.grad_fn(Xs, Y_targets, batched=True)
+        (losses, (batch_processor_states, Y_target_features)), grads = grad_fn(
+            params_to_unit_scale(self.current_params, self.processor.NAME),
+            processor_states,
+            Xs,
+            Y_targets,
+            self.features_for(Y_targets, Y_targets_features),
+        )
+        self.batch_processor_states = in_processor_order(
+            self.processor_key, batch_processor_states
+        )
+        self.cache_features(Y_targets, Y_target_features)
+        self.loss, self.grads = mean_loss_and_grads(losses, grads)
+        self.apply_grads()
+        return self.batch_processor_states
+
+    def step_window(self, Xs, Y_targets, Y_targets_features=None):
+        """Take a single optimizer step using the mean loss over a window of consecutive buffers,
+        stacked along the first axis, starting from the trainer's current processor state.
+        The state is chained through the window, so gradients account for each buffer's effect
+        on the following buffers (e.g. reverb and delay tails), and is detached after the window.
+        """
+        grad_fn = self.grad_fn(Xs, Y_targets, windowed=True)
+        (self.loss, (processor_state, Y_targets_features)), self.grads = grad_fn(
+            params_to_unit_scale(self.current_params, self.processor.NAME),
+            self.processor_state,
+            Xs,
+            Y_targets,
+            self.features_for(Y_targets, Y_targets_features),
+        )
+        self.processor_state = in_processor_order(self.processor_key, processor_state)
+        self.cache_features(Y_targets, Y_targets_features)
+        self.apply_grads()
+
+    def step_stream(self, X, Y_target):
+        """Collect consecutive buffers of a stream, taking a `step_window` every `window_size` buffers.
+        Returns whether a step was taken."""
+        self.stream_window.append((X, Y_target))
+        if len(self.stream_window) < self.window_size:
+            return False
+        Xs, Y_targets = zip(*self.stream_window)
+        self.stream_window = []
+        self.step_window(jnp.stack(Xs), jnp.stack(Y_targets))
+        return True
+
+    def train(self, Xs, Y_targets, num_steps=None, Y_targets_features=None):
+        """Run `num_steps` steps (defaulting to one pass over the buffers) entirely on-device, as a
+        single compiled program, cycling through the buffers in `Xs` and `Y_targets` (stacked along the
+        first axis) and continuing from the trainer's current optimizer and processor state.
+        The (stacked) target features are computed once for the whole run, unless passed in
+        `Y_targets_features` (from `target_features`) or cached from the previous run over `Y_targets`.
+        Returns the losses, and the params each loss was computed with, stacked by step.
+        """
+        num_steps = num_steps or len(Xs)
+        features = self.features_for(Y_targets, Y_targets_features)
+        if features is None:
+            features = self.target_features(Y_targets)[1]
+        self.cache_features(Y_targets, features)
+        optimize_fn = compiled_optimize_fn(
+            self.processor_key,
+            self.loss_options,
+            self.multichannel,
+            self.checkpoint_segment_size,
+            self.optimizer.definition.NAME,
+            tuple(sorted(self.optimizer.param_values.items())),
+            num_steps,
+            Xs.shape,
+            Y_targets.shape,
+            Xs.dtype,
+        )
+        losses, params_history, self.opt_state, processor_state = optimize_fn(
+            self.opt_state, self.step_num, self.processor_state, Xs, Y_targets, features
         )
+        self.processor_state = in_processor_order(self.processor_key, processor_state)
+        self.step_num += num_steps
+        self.loss = losses[-1]
+        self.current_params = params_from_unit_scale(
+            self.optimizer.get_params(self.opt_state), self.processor.NAME
+        )
+        params_history = params_from_unit_scale(params_history, self.processor.NAME)
+        if self.step_evaluator:
+            self.step_evaluator.after_steps(
+                losses,
+                tree_multimap(
+                    lambda params, current_params: jnp.concatenate(
+                        [params[1:], current_params[None]]
+                    ),
+                    params_history,
+                    self.current_params,
+                ),
+            )
+        return losses, params_history
+
+    def apply_grads(self):
         self.opt_state = self.optimizer.update(
             self.step_num, self.grads, self.opt_state
         )
@@ -130,6 +577,79 @@ class IterativeTrainer:
         }
 
 
+class PopulationTrainer:
+    """Optimizes a population of initial params in parallel, as a single compiled program.
+    Useful for non-convex params (like `delay_samples` or `frequency_hz`) that gradient descent
+    from a single starting point can't reliably find."""
+
+    def __init__(
+        self,
+        processor,
+        params_inits,
+        loss_options=None,
+        optimizer_options=None,
+        processor_state=None,
+        multichannel=False,
+    ):
+        """`params_inits` is either a list of params dicts, or a single params dict with each
+        param stacked along the first axis."""
+        self.processor = processor
+        self.processor_state = processor_state or processor.state_init()
+        self.processor_key = processor_key(processor, self.processor_state)
+        self.params_inits = (
+            tree_multimap(lambda *params: jnp.stack(params), *params_inits)
+            if isinstance(params_inits, (list, tuple))
+            else params_inits
+        )
+        self.loss_options = loss_options or LossOptions()
+        self.optimizer = (
+            create_optimizer(
+                optimizer_options.get("name"), optimizer_options.get("params")
+            )
+            if optimizer_options
+            else create_optimizer()
+        )
+        self.multichannel = multichannel
+        self.loss_history = None
+        self.params_history = None
+        self.current_params = None
+
+    def train(self, Xs, Y_targets, num_steps):
+        """Run `num_steps` steps for every member of the population, cycling through the buffers in
+        `Xs` and `Y_targets` (stacked along the first axis).
+        Returns the loss history, with shape `(population size, num_steps)`."""
+        optimize_fn = compiled_population_optimize_fn(
+            self.processor_key,
+            self.loss_options,
+            self.multichannel,
+            self.optimizer.definition.NAME,
+            tuple(sorted(self.optimizer.param_values.items())),
+            num_steps,
+            Xs.shape,
+            Y_targets.shape,
+            Xs.dtype,
+        )
+        self.loss_history, params_history, params = optimize_fn(
+            params_to_unit_scale(self.params_inits, self.processor.NAME),
+            self.processor_state,
+            Xs,
+            Y_targets,
+        )
+        self.params_history = params_from_unit_scale(
+            params_history, self.processor.NAME
+        )
+        self.current_params = params_from_unit_scale(params, self.processor.NAME)
+        return self.loss_history
+
+    def best(self, n=1):
+        """The `n` (params, loss) pairs with the lowest loss at the last step, best first."""
+        losses = self.loss_history[:, -1]
+        return [
+            (tree_map(lambda params: params[i, -1], self.params_history), losses[i])
+            for i in np.argsort(losses)[:n]
+        ]
+
+
 def evaluate(carry_estimated, carry_target, processor, X):
     carry_estimated, Y_estimated = processor.tick_buffer(carry_estimated, X)
     carry_target, Y_target = processor.tick_buffer(carry_target, X)
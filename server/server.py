@@ -8,9 +8,14 @@ import os
 import ssl
 import uuid
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import jax
 import jax.numpy as jnp
-from collections import deque
+from jax import jit, vmap
+from jax.tree_util import tree_flatten, tree_map, tree_multimap
+from functools import lru_cache
 
 from aiohttp import web
 import aiohttp_cors
@@ -20,38 +25,280 @@ from jaxdsp.processors import (
     serial_processors,
     allpass_filter,
     clip,
+    iir_filter,
     lowpass_feedback_comb_filter,
     sine_wave,
     processor_by_name,
     empty_carry,
     serialize_processor,
     default_param_values,
-    is_nested_processor,
+    multichannel_state,
+    tick_buffer_multichannel,
+    processor_key,
+    processor_for_key,
+    in_processor_order,
+    processor_for_node_key,
+)
+from jaxdsp.processors.processor_graph import (
+    ProcessorGraph,
+    INPUT_KEY as GRAPH_INPUT_KEY,
 )
 from jaxdsp.training import IterativeTrainer
 from jaxdsp.optimizers import create_optimizer, all_optimizer_definitions
 
 from jaxdsp.loss import LossOptions
+from jaxdsp.replay_buffer import ReplayBuffer
 
 ALL_PROCESSORS = [allpass_filter, clip, lowpass_feedback_comb_filter, sine_wave]
-# Training frame pairs are queued up for each client, limited to this cap:
+# The most recent training frame pairs are retained for each client, limited to this cap:
 MAX_TRAIN_FRAMES_PER_CLIENT = 100
+# Each training step averages gradients over a minibatch of retained frame pairs.
+TRAIN_BATCH_SIZE = 16
+# Sample recent frame pairs more often, halving the sampling probability every this many pairs.
+TRAIN_RECENCY_HALF_LIFE = 25
+# Frame pairs waiting for the next training job are capped per client, dropping the oldest,
+# so a client whose training falls behind can't grow its queue without limit.
+MAX_PENDING_TRAIN_FRAMES_PER_CLIENT = 8
+# Each received frame pair allows this many more training steps, so an estimating client's train loop
+# waits for new audio rather than stepping back to back on its retained pairs,
+# starving other clients of the shared training workers.
+TRAIN_STEPS_PER_FRAME = 4
+# Training jobs for all clients share a pool of this many worker threads by default.
+DEFAULT_TRAINING_WORKERS = 2
+# Buffers from clients with the same processor structure are processed together in one batch.
+# A batch is processed once every client that was in the previous batch has submitted a buffer,
+# or at most this long after the first buffer was submitted.
+DEFAULT_BATCH_PROCESSING_DEADLINE_SECONDS = 0.005
+# Negotiated opus packets are 20ms, which is 960 samples per channel at 48kHz.
+SAMPLES_PER_PACKET = 960
+DEFAULT_PACKETS_PER_BUFFER = 3
+MAX_PACKETS_PER_BUFFER = 8
+# Clients with a latency budget have their buffer size reconsidered every this many buffers.
+BUFFER_SIZE_ADAPT_INTERVAL = 20
+# Buffer sizes whose processing takes more than this fraction of their duration can't keep up reliably.
+MAX_PROCESSING_DURATION_FRACTION = 0.5
+DEFAULT_SAMPLE_RATE = 48000
+NUM_CHANNELS = 2
+# Compiling at startup every buffer size clients can adapt to means adapting never waits on compilation.
+WARMUP_BUFFER_SIZES = [
+    SAMPLES_PER_PACKET * packets_per_buffer
+    for packets_per_buffer in range(1, MAX_PACKETS_PER_BUFFER + 1)
+]
+DEFAULT_COMPILATION_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "jaxdsp", "xla"
+)
 
 logger = logging.getLogger("pc")
 track_for_client_uid = {}
 peer_connections = set()
+training_executor = None
+processing_scheduler = None
 
 int_max = np.iinfo(np.int16).max
 
 
+def log_training_job_exception(future):
+    if not future.cancelled() and future.exception():
+        logger.error("Training job failed", exc_info=future.exception())
+
+
+@lru_cache(maxsize=None)
+def batched_tick_buffer(key):
+    processor = processor_for_key(key)
+
+    def tick_buffer(carry, X):
+        return tick_buffer_multichannel(
+            processor,
+            {name: in_processor_order(key, values) for name, values in carry.items()},
+            X,
+        )
+
+    return jit(vmap(tick_buffer))
+
+
+def compile_batched_tick_buffer(processor, carry, X, batch_size):
+    """Compile `batched_tick_buffer` for a batch of `batch_size` buffers shaped like `X`, by running it."""
+    _, Ys = batched_tick_buffer(processor_key(processor, carry["state"]))(
+        tree_map(lambda leaf: jnp.stack([leaf] * batch_size), carry),
+        np.stack([X] * batch_size),
+    )
+    np.asarray(Ys)  # Wait for the result.
+
+
+class ProcessingScheduler:
+    """Groups buffers submitted by all clients with the same processor structure and buffer shape,
+    and processes each group with a single vmapped `tick_buffer` call."""
+
+    def __init__(self, deadline_seconds=DEFAULT_BATCH_PROCESSING_DEADLINE_SECONDS):
+        self.deadline_seconds = deadline_seconds
+        self.pending_for_group = {}
+        self.deadline_timer_for_group = {}
+        self.group_for_client = {}
+        self.clients_for_group = {}
+
+    # Returns a future resolving to `(carry, Y)`, as returned by `tick_buffer_multichannel`.
+    def submit(self, client, processor, carry, X):
+        key = processor_key(processor, carry["state"])
+        leaves, structure = tree_flatten(carry)
+        group = (
+            key,
+            structure,
+            tuple((np.shape(leaf), np.result_type(leaf)) for leaf in leaves),
+            X.shape,
+            X.dtype,
+        )
+        if self.group_for_client.get(client) != group:
+            self.remove(client)
+            self.group_for_client[client] = group
+            self.clients_for_group.setdefault(group, set()).add(client)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        pending = self.pending_for_group.setdefault(group, [])
+        pending.append((carry, X, future))
+        if len(pending) >= len(self.clients_for_group[group]):
+            self.process(group)
+        elif len(pending) == 1:
+            self.deadline_timer_for_group[group] = loop.call_later(
+                self.deadline_seconds, self.process, group
+            )
+        return future
+
+    # The number of clients whose buffers are batched with this client's, including its own.
+    def group_size(self, client):
+        group = self.group_for_client.get(client)
+        return len(self.clients_for_group[group]) if group is not None else 1
+
+    # Stop waiting for buffers from a client that's no longer processing.
+    def remove(self, client):
+        group = self.group_for_client.pop(client, None)
+        if group is None:
+            return
+
+        clients = self.clients_for_group[group]
+        clients.discard(client)
+        if not clients:
+            del self.clients_for_group[group]
+        pending = self.pending_for_group.get(group)
+        if pending and len(pending) >= len(clients):
+            self.process(group)
+
+    def process(self, group):
+        timer = self.deadline_timer_for_group.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self.pending_for_group.pop(group, None)
+        if not pending:
+            return
+
+        key = group[0]
+        try:
+            if len(pending) == 1:
+                carry, X, _ = pending[0]
+                results = [
+                    tick_buffer_multichannel(
+                        processor_for_key(key), carry, X, donate_state=True
+                    )
+                ]
+            else:
+                carries, Xs, _ = zip(*pending)
+                carry, Ys = batched_tick_buffer(key)(
+                    tree_multimap(lambda *leaves: jnp.stack(leaves), *carries),
+                    jnp.stack(Xs),
+                )
+                results = [
+                    (
+                        {
+                            name: in_processor_order(
+                                key, tree_map(lambda leaf: leaf[i], values)
+                            )
+                            for name, values in carry.items()
+                        },
+                        Ys[i],
+                    )
+                    for i in range(len(pending))
+                ]
+        except Exception as error:
+            for _, _, future in pending:
+                future.set_exception(error)
+            return
+
+        for (_, _, future), result in zip(pending, results):
+            if not future.cancelled():
+                future.set_result(result)
+
+
+class BufferSizeController:
+    """Chooses the number of packets per buffer with the most throughput, within a latency budget.
+
+    The latency added by buffering `n` packets is the `n - 1` packets waited for, plus the processing time.
+    Processing times are measured per size, and extrapolated linearly to other sizes."""
+
+    def __init__(self, latency_budget_seconds=None, smoothing=0.9):
+        self.latency_budget_seconds = latency_budget_seconds
+        self.smoothing = smoothing
+        self.processing_seconds_for_size = {}
+
+    def clear(self):
+        self.processing_seconds_for_size = {}
+
+    def record(self, packets_per_buffer, processing_seconds):
+        previous = self.processing_seconds_for_size.get(packets_per_buffer)
+        self.processing_seconds_for_size[packets_per_buffer] = (
+            processing_seconds
+            if previous is None
+            else self.smoothing * previous + (1 - self.smoothing) * processing_seconds
+        )
+
+    def estimated_processing_seconds(self, packets_per_buffer):
+        measured = self.processing_seconds_for_size.get(packets_per_buffer)
+        if measured is not None:
+            return measured
+        if not self.processing_seconds_for_size:
+            return 0.0
+        return max(
+            seconds * packets_per_buffer / size
+            for size, seconds in self.processing_seconds_for_size.items()
+        )
+
+    def packets_per_buffer(self, packet_seconds):
+        if self.latency_budget_seconds is None:
+            return DEFAULT_PACKETS_PER_BUFFER
+
+        sizes = range(1, MAX_PACKETS_PER_BUFFER + 1)
+        keeps_up = [
+            size
+            for size in sizes
+            if self.estimated_processing_seconds(size)
+            <= MAX_PROCESSING_DURATION_FRACTION * size * packet_seconds
+        ]
+        within_budget = [
+            size
+            for size in keeps_up
+            if (size - 1) * packet_seconds + self.estimated_processing_seconds(size)
+            <= self.latency_budget_seconds
+        ]
+        if within_budget:
+            return max(within_budget)
+        # Keeping up takes priority over the budget, since falling behind drops audio.
+        return min(keeps_up) if keeps_up else MAX_PACKETS_PER_BUFFER
+
+
 class AudioTransformTrack(MediaStreamTrack):
     kind = "audio"
 
-    def __init__(self, track, train_stack):
+    # Training runs in `training_executor` (inline if it's `None`), one job at a time per client,
+    # so neither compiling nor computing gradients ever blocks `recv` for any client.
+    # The trainer and replay buffer are only touched by training jobs.
+    # Processing is batched with other clients' in `processing_scheduler`, if one is given.
+    def __init__(
+        self, track, replay_buffer, training_executor=None, processing_scheduler=None
+    ):
         super().__init__()
         self.track = track
         self.processor = None
         self.processor_state = None
+        self.sample_rate = DEFAULT_SAMPLE_RATE
         self.is_estimating_params = False
         self.processor_params = None
         self.trainer = IterativeTrainer(
@@ -59,8 +306,16 @@ class AudioTransformTrack(MediaStreamTrack):
             loss_options=None,
             optimizer_options=None,
             processor_params=None,
+            multichannel=True,
         )
-        self.train_stack = train_stack
+        self.replay_buffer = replay_buffer
+        self.pending_train_pairs = deque(maxlen=MAX_PENDING_TRAIN_FRAMES_PER_CLIENT)
+        self.training_executor = training_executor
+        self.processing_scheduler = processing_scheduler
+        self.last_training_job = None
+        self.train_step_budget = 0
+        # Set whenever there may be new training work, so idle clients' train loops just wait on it.
+        self.train_data_event = asyncio.Event()
         self.previous_frame = None
 
         # Accumulate `packets_per_buffer` packets before processing them all at once,
@@ -78,9 +333,100 @@ class AudioTransformTrack(MediaStreamTrack):
         #
         # (Note: the opus 44100 Hz negotiation with both client and server on my machine only seems
         # to support 20ms packet sizes, otherwise this work would best be done in the RTC negotiation.)
-        self.packets_per_buffer = 3  # TODO allow changing in realtime by client
-        self.accumulated_packets = []
-        self.processed_packets = []
+        #
+        # Clients can set a latency budget, to adapt the buffer size to the largest that fits in it.
+        # Sizes are only switched to once compiled (in the background), and only between buffers.
+        # Growing the buffer inserts silence while the larger buffer accumulates.
+        # Shrinking it skips the packets of the previous buffer that haven't been played yet
+        # (dropping the extra latency), crossfading from the next of them into the new buffer.
+        self.packets_per_buffer = DEFAULT_PACKETS_PER_BUFFER
+        self.buffer_size_controller = BufferSizeController()
+        self.compiled_buffer_shapes = set()
+        self.compiling_buffer_shapes = set()
+        self.num_processed_buffers = 0
+        self.is_buffer_size_changed = True
+        #
+        # Packets are converted and (de)interleaved in place, in buffers preallocated for the largest buffer size,
+        # to avoid allocating arrays for every packet.
+        self.input_samples = None  # (channels, samples) float32
+        self.output_samples = None  # Interleaved int16
+        self.silence = None
+        self.num_accumulated_packets = 0
+        self.num_processed_packets = 0
+        self.num_output_packets = 0
+
+    def allocate_packet_buffers(self, num_channels, samples_per_packet):
+        max_buffer_size = MAX_PACKETS_PER_BUFFER * samples_per_packet
+        self.input_samples = np.zeros((num_channels, max_buffer_size), dtype=np.float32)
+        self.output_samples = np.zeros(num_channels * max_buffer_size, dtype=np.int16)
+        self.silence = np.zeros(num_channels * samples_per_packet, dtype=np.int16)
+        self.num_accumulated_packets = 0
+        self.num_processed_packets = 0
+        self.num_output_packets = 0
+
+    def set_latency_budget(self, latency_budget_seconds):
+        self.buffer_size_controller.latency_budget_seconds = latency_budget_seconds
+
+    def buffer_shape(self, packets_per_buffer):
+        return (
+            processor_key(self.processor, self.processor_state),
+            self.sample_rate,
+            packets_per_buffer,
+        )
+
+    # Compile the processor for a buffer size in the background, without blocking the audio path.
+    def precompile(self, packets_per_buffer, samples_per_packet):
+        buffer_shape = self.buffer_shape(packets_per_buffer)
+        if buffer_shape in self.compiling_buffer_shapes:
+            return
+
+        self.compiling_buffer_shapes.add(buffer_shape)
+        processor = self.processor
+        # The audio path donates its state buffers, so compile with a copy.
+        carry = {
+            "params": self.processor_params,
+            "state": tree_map(jnp.array, self.processor_state),
+        }
+        X = np.zeros(
+            (NUM_CHANNELS, packets_per_buffer * samples_per_packet), dtype=np.float32
+        )
+        # Buffers batched with other clients' are processed with a vmapped `tick_buffer` instead.
+        group_size = (
+            self.processing_scheduler.group_size(self)
+            if self.processing_scheduler
+            else 1
+        )
+
+        def compile():
+            if group_size > 1:
+                compile_batched_tick_buffer(processor, carry, X, group_size)
+            _, Y = tick_buffer_multichannel(processor, carry, X, donate_state=True)
+            np.asarray(Y)  # Wait for the result.
+
+        def on_compiled(future):
+            self.compiling_buffer_shapes.discard(buffer_shape)
+            if not future.exception():
+                self.compiled_buffer_shapes.add(buffer_shape)
+
+        future = asyncio.get_event_loop().run_in_executor(None, compile)
+        future.add_done_callback(on_compiled)
+
+    # Called between buffers, to switch to the buffer size chosen by the controller once it's compiled.
+    def adapt_packets_per_buffer(self, samples_per_packet):
+        if not self.processor:
+            return
+
+        packets_per_buffer = self.buffer_size_controller.packets_per_buffer(
+            samples_per_packet / self.sample_rate
+        )
+        if packets_per_buffer == self.packets_per_buffer:
+            return
+
+        if self.buffer_shape(packets_per_buffer) in self.compiled_buffer_shapes:
+            self.packets_per_buffer = packets_per_buffer
+            self.is_buffer_size_changed = True
+        else:
+            self.precompile(packets_per_buffer, samples_per_packet)
 
     def set_processor(self, processor, params=None, state=None):
         if not processor:
@@ -89,55 +435,178 @@ class AudioTransformTrack(MediaStreamTrack):
             self.processor_state = None
             return
 
-        state = state or processor.state_init()
-        if not self.processor or self.processor.NAME != processor.NAME or state.keys() != self.processor_state.keys():
+        state = multichannel_state(
+            processor,
+            state or processor.state_init(sample_rate=self.sample_rate),
+            NUM_CHANNELS,
+        )
+        if not self.processor or processor_key(
+            self.processor, self.processor_state
+        ) != processor_key(processor, state):
             self.processor = processor
             self.processor_state = state
-            # Don't pass any params to the trainer - that would be cheating ;)
-            self.trainer.set_processor(self.processor, None, self.processor_state)
+            # Processing times are specific to the processor.
+            self.buffer_size_controller.clear()
+            self.is_buffer_size_changed = True
+            # The audio path donates its state buffers, so the trainer gets its own copy.
+            self.schedule_training_job(
+                self.set_trainer_processor, processor, tree_map(jnp.array, state)
+            )
 
         # This is also the path to update processor params, regardless of whether the processor has changed.
         self.processor_params = params or default_param_values(processor, self.processor_state)
+        # Recorded targets are stale once the processor or its params change.
+        # (Replaced rather than cleared, since a running training job may be draining it.)
+        self.pending_train_pairs = deque(maxlen=MAX_PENDING_TRAIN_FRAMES_PER_CLIENT)
+        self.schedule_training_job(self.replay_buffer.clear)
+
+    def set_trainer_processor(self, processor, state):
+        # Don't pass any params to the trainer - that would be cheating ;)
+        self.trainer.set_processor(processor, None, state)
+
+    def schedule_training_job(self, job, *args):
+        """Run `job` in the training executor, after all training jobs previously scheduled for this client.
+        Returns a future for its result."""
+        if self.training_executor is None:
+            return job(*args)
+
+        previous_job = self.last_training_job
+
+        async def run_job():
+            if previous_job:
+                await asyncio.wait([previous_job])
+            return await asyncio.get_event_loop().run_in_executor(
+                self.training_executor, job, *args
+            )
+
+        self.last_training_job = asyncio.ensure_future(run_job())
+        # Most jobs are scheduled without awaiting their result, which would otherwise drop their exceptions.
+        self.last_training_job.add_done_callback(log_training_job_exception)
+        return self.last_training_job
+
+    # Processor state (e.g. delay line buffers) is sized for the sample rate,
+    # so it's reinitialized whenever the sample rate changes.
+    def set_sample_rate(self, sample_rate):
+        self.sample_rate = sample_rate
+        if not self.processor:
+            return
+
+        if self.processor is serial_processors:
+            state = serial_processors.state_init(
+                list(self.processor_state.keys()), sample_rate=sample_rate
+            )
+        else:
+            state = self.processor.state_init(sample_rate=sample_rate)
+        self.processor_state = multichannel_state(self.processor, state, NUM_CHANNELS)
+        self.schedule_training_job(
+            self.set_trainer_processor_state, tree_map(jnp.array, self.processor_state)
+        )
+
+    def set_trainer_processor_state(self, processor_state):
+        self.trainer.processor_state = processor_state
 
     def set_loss_options(self, loss_options):
+        self.schedule_training_job(self.set_trainer_loss_options, loss_options)
+
+    def set_trainer_loss_options(self, loss_options):
         self.trainer.set_loss_options(loss_options)
+        if len(self.replay_buffer) > 0:
+            # Recompute all retained target features for the new loss options at once.
+            self.replay_buffer.set_field(
+                "Y_features",
+                self.trainer.target_features(self.replay_buffer.items["Y"])[1],
+            )
 
     def set_optimizer_options(self, optimizer_options):
-        self.trainer.set_optimizer_options(optimizer_options)
+        self.schedule_training_job(
+            self.trainer.set_optimizer_options, optimizer_options
+        )
 
     def start_estimating_params(self):
         self.is_estimating_params = True
+        self.train_data_event.set()
 
     def stop_estimating_params(self):
         self.is_estimating_params = False
 
-    # Takes a 2d array and returns a processed 2d array
+    def record_train_pair(self, X, Y):
+        # Target features never change once recorded, so they're computed once here
+        # rather than on every training step.
+        self.replay_buffer.add(
+            {
+                "X": X,
+                "Y": Y,
+                "Y_features": self.trainer.target_features(Y)[1],
+            }
+        )
+
+    def has_train_data(self):
+        return len(self.pending_train_pairs) > 0 or len(self.replay_buffer) > 0
+
+    def has_train_step_budget(self):
+        return self.train_step_budget > 0 and self.has_train_data()
+
+    def train_step(self):
+        """Record all pending frame pairs, then take a training step on a minibatch sampled from the recorded pairs.
+        Returns the resulting train state, or `None` if there are no recorded pairs
+        (e.g. they were cleared by a processor change after this step was scheduled)."""
+        pending_train_pairs = self.pending_train_pairs
+        while len(pending_train_pairs) > 0:
+            self.record_train_pair(*pending_train_pairs.popleft())
+        if len(self.replay_buffer) == 0:
+            return None
+
+        batch = self.replay_buffer.sample(TRAIN_BATCH_SIZE)
+        self.trainer.step_batch(
+            batch["X"],
+            batch["Y"],
+            Y_targets_features=(self.trainer.loss_options, batch["Y_features"]),
+        )
+        return self.trainer.params_and_loss()
+
+    # Takes a (channels, samples) array and returns a processed (channels, samples) array
     def process(self, X, sample_rate):
-        X_left = X[0]  # TODO handle stereo in
+        if sample_rate != self.sample_rate:
+            self.set_sample_rate(sample_rate)
 
         if self.processor:
-            if is_nested_processor(self.processor):
-                for inner_processor_state in self.processor_state.values():
-                    inner_processor_state["sample_rate"] = sample_rate
-            else:
-                self.processor_state["sample_rate"] = sample_rate
-
-            carry, Y = self.processor.tick_buffer(
+            carry, Y = tick_buffer_multichannel(
+                self.processor,
                 {
                     "params": self.processor_params,
                     "state": self.processor_state,
                 },
-                X_left,
+                X,
+                donate_state=True,
             )
         else:
-            carry, Y = (empty_carry, X_left)
+            carry, Y = (empty_carry, X)
 
         self.processor_state = carry["state"]
+        return np.array(Y)
+
+    async def process_scheduled(self, X, sample_rate):
+        """Like `process`, but batched with other clients' buffers by the processing scheduler."""
+        if not self.processing_scheduler:
+            return self.process(X, sample_rate)
+        if not self.processor:
+            self.processing_scheduler.remove(self)
+            return self.process(X, sample_rate)
 
-        # Transposing to conform to processors with stereo output.
-        # Stereo processing is done that way to support the same
-        # array-of-ticks processing for both stereo and mono.
-        return np.array([Y, Y]) if Y.ndim == 1 else np.asarray(Y).T
+        if sample_rate != self.sample_rate:
+            self.set_sample_rate(sample_rate)
+
+        processor_state = self.processor_state
+        carry, Y = await self.processing_scheduler.submit(
+            self,
+            self.processor,
+            {"params": self.processor_params, "state": processor_state},
+            X,
+        )
+        # Don't clobber state reset (e.g. by a processor change) while this buffer was being processed.
+        if self.processor_state is processor_state:
+            self.processor_state = carry["state"]
+        return np.asarray(Y)
 
     async def recv(self):
         frame = await self.track.recv()
@@ -145,38 +614,88 @@ class AudioTransformTrack(MediaStreamTrack):
         assert (
             frame.format.is_packed
         ), "Processing assumes frames are packed, but frame is planar"
-        assert num_channels == 2, "Processing assumes frames have 2 channels"
+        assert (
+            num_channels == NUM_CHANNELS
+        ), f"Processing assumes frames have {NUM_CHANNELS} channels"
 
-        X_interleaved = (
-            np.frombuffer(frame.planes[0], dtype=np.int16).astype(np.float32) / int_max
+        samples_per_packet = frame.samples
+        packet_size = num_channels * samples_per_packet
+        if self.silence is None or self.silence.size != packet_size:
+            self.allocate_packet_buffers(num_channels, samples_per_packet)
+
+        # Deinterleave and convert to float directly into the accumulated input buffer.
+        packet_start = self.num_accumulated_packets * samples_per_packet
+        np.divide(
+            np.frombuffer(frame.planes[0], dtype=np.int16).reshape(-1, num_channels).T,
+            int_max,
+            out=self.input_samples[:, packet_start : packet_start + samples_per_packet],
         )
-        X_deinterleaved = [
-            X_interleaved[channel_num::num_channels]
-            for channel_num in range(num_channels)
-        ]
+        self.num_accumulated_packets += 1
 
-        self.accumulated_packets.append(X_deinterleaved)
-        if len(self.accumulated_packets) == self.packets_per_buffer:
-            X = np.hstack(self.accumulated_packets)
-            Y = self.process(X, frame.sample_rate)
-            self.processed_packets = np.split(Y, self.packets_per_buffer, axis=1)
-            self.accumulated_packets = []
+        if self.num_accumulated_packets == self.packets_per_buffer:
+            packets_per_buffer = self.packets_per_buffer
+            X = self.input_samples[:, : packets_per_buffer * samples_per_packet]
+            start_time = time.perf_counter()
+            Y = await self.process_scheduled(X, frame.sample_rate)
+            # Only after shrinking the buffer are there unplayed packets left from the previous buffer.
+            skipped_packet = None
+            if self.num_processed_packets < self.num_output_packets:
+                skipped_start = self.num_processed_packets * packet_size
+                skipped_packet = self.output_samples[
+                    skipped_start : skipped_start + packet_size
+                ].astype(np.float32)
+            # The first buffer after a change may include compilation, which isn't representative.
+            if not self.is_buffer_size_changed:
+                self.buffer_size_controller.record(
+                    packets_per_buffer, time.perf_counter() - start_time
+                )
+            self.is_buffer_size_changed = False
+            if self.processor:
+                self.compiled_buffer_shapes.add(self.buffer_shape(packets_per_buffer))
+
+            # Interleave and convert to int16 directly into the output buffer.
+            Y_interleaved = self.output_samples[: Y.size].reshape(-1, num_channels)
+            for channel_num in range(num_channels):
+                np.multiply(
+                    Y[channel_num],
+                    int_max,
+                    out=Y_interleaved[:, channel_num],
+                    casting="unsafe",
+                )
+            if skipped_packet is not None:
+                fade_in = np.repeat(
+                    np.linspace(0, 1, samples_per_packet, dtype=np.float32),
+                    num_channels,
+                )
+                first_packet = self.output_samples[:packet_size]
+                first_packet[:] = (
+                    skipped_packet * (1 - fade_in) + first_packet * fade_in
+                )
+            self.num_output_packets = packets_per_buffer
+            self.num_processed_packets = 0
+            self.num_accumulated_packets = 0
             if self.is_estimating_params:
-                self.train_stack.append([X, Y])
+                # The input buffer is reused for the next packets.
+                self.pending_train_pairs.append((X.copy(), Y))
+                self.train_step_budget = min(
+                    self.train_step_budget + TRAIN_STEPS_PER_FRAME,
+                    MAX_PENDING_TRAIN_FRAMES_PER_CLIENT * TRAIN_STEPS_PER_FRAME,
+                )
+                self.train_data_event.set()
 
-        if len(self.processed_packets) > 0:
-            Y_deinterleaved = self.processed_packets.pop(0)
-            Y_interleaved = np.empty(
-                (Y_deinterleaved.shape[1] * 2,), dtype=Y_deinterleaved.dtype
-            )
-            Y_interleaved[0::2] = Y_deinterleaved[0]
-            Y_interleaved[1::2] = Y_deinterleaved[1]
+            self.num_processed_buffers += 1
+            if self.num_processed_buffers % BUFFER_SIZE_ADAPT_INTERVAL == 0:
+                self.adapt_packets_per_buffer(samples_per_packet)
 
-            out_samples = (Y_interleaved * int_max).astype(np.int16)
+        if self.num_processed_packets < self.num_output_packets:
+            packet_start = self.num_processed_packets * packet_size
+            out_samples = self.output_samples[packet_start : packet_start + packet_size]
+            self.num_processed_packets += 1
         else:
             # Fill with silence while waiting to receive enough packets to process.
-            # Should only hit this case for the first `packets_per_buffer - 1` packets.
-            out_samples = np.zeros(X_interleaved.size, dtype="int16")
+            # Should only hit this case for the first `packets_per_buffer - 1` packets,
+            # and when the buffer size grows.
+            out_samples = self.silence
 
         frame.planes[0].update(out_samples)
         return frame
@@ -192,7 +711,12 @@ async def index(request):
 async def offer(request):
     client_uid = str(uuid.uuid4())
     audio_transform_track = AudioTransformTrack(
-        None, deque([], MAX_TRAIN_FRAMES_PER_CLIENT)
+        None,
+        ReplayBuffer(
+            MAX_TRAIN_FRAMES_PER_CLIENT, recency_half_life=TRAIN_RECENCY_HALF_LIFE
+        ),
+        training_executor,
+        processing_scheduler,
     )
 
     params = await request.json()
@@ -217,20 +741,48 @@ async def offer(request):
             if len(processor_config) == 0:
                 return None, None, None
 
+            # Processors can have a node `"key"` (see `processor_for_node_key`),
+            # to chain the same processor more than once.
+            node_keys = [
+                processor.get("key", processor["name"]) for processor in processor_config
+            ]
             params = {
-                processor["name"]: processor["params"]
-                for processor in processor_config
+                node_key: processor["params"]
+                for node_key, processor in zip(node_keys, processor_config)
             }
             state = serial_processors.state_init(
-                [
-                    processor_by_name[processor["name"]]
-                    for processor in processor_config
-                ]
+                node_keys, sample_rate=audio_transform_track.sample_rate
             )
             return serial_processors, params, state
 
+        # Graphs are configured as `{"nodes": [{"key", "inputs", "params"}, ...], "outputs": [...]}`.
+        # (See `ProcessorGraph` for details.)
+        if "nodes" in processor_config:
+            nodes = processor_config["nodes"]
+            processor = ProcessorGraph(
+                [
+                    (node["key"], node.get("inputs", [GRAPH_INPUT_KEY]))
+                    for node in nodes
+                ],
+                processor_config["outputs"],
+            )
+            params = {
+                node["key"]: node.get("params")
+                or default_param_values(processor_for_node_key(node["key"]))
+                for node in nodes
+            }
+            return (
+                processor,
+                params,
+                processor.state_init(sample_rate=audio_transform_track.sample_rate),
+            )
+
         processor = processor_by_name.get(processor_config["name"])
-        return processor, processor_config["params"], processor.state_init()
+        return (
+            processor,
+            processor_config["params"],
+            processor.state_init(sample_rate=audio_transform_track.sample_rate),
+        )
 
     @peer_connection.on("datachannel")
     def on_datachannel(channel):
@@ -254,6 +806,7 @@ async def offer(request):
                                 audio_transform_track.trainer.current_params,
                             ),
                             "loss_options": audio_transform_track.trainer.loss_options.serialize(),
+                            "packets_per_buffer": audio_transform_track.packets_per_buffer,
                         }
                     )
                 )
@@ -275,6 +828,11 @@ async def offer(request):
                             fft_sizes=loss_options.get("fft_sizes"),
                         )
                     )
+                if "latency_budget_ms" in message_dict:
+                    latency_budget_ms = message_dict["latency_budget_ms"]
+                    audio_transform_track.set_latency_budget(
+                        None if latency_budget_ms is None else latency_budget_ms / 1000
+                    )
                 optimizer_options = message_dict.get("optimizer")
                 if optimizer_options:
                     audio_transform_track.set_optimizer_options(optimizer_options)
@@ -301,6 +859,8 @@ async def offer(request):
         @track.on("ended")
         async def on_ended():
             log_info("Track %s ended", track.kind)
+            if processing_scheduler:
+                processing_scheduler.remove(audio_transform_track)
             del track_for_client_uid[client_uid]
 
     # handle offer
@@ -339,22 +899,113 @@ async def register_websocket(websocket, path):
     track = track_for_client_uid.get(client_uid)
     if not track:
         print(f"No track cached for client_uid {client_uid}")
+        return
 
-    train_stack = track.train_stack
-    while True:
-        try:
-            if track.is_estimating_params and track.trainer and len(train_stack) > 0:
-                train_pair = train_stack.pop()
-                X, Y = train_pair
-                X_left = X[0]  # TODO support stereo in
-                track.trainer.step(X_left, Y)
-                await websocket.send(
-                    json.dumps({"train_state": track.trainer.params_and_loss()})
+    # Training and sending are decoupled, so a slow client never holds up training,
+    # and only receives the latest train state rather than a backlog of them.
+    latest_train_state = None
+    train_state_event = asyncio.Event()
+
+    async def train():
+        nonlocal latest_train_state
+        while True:
+            if not (track.is_estimating_params and track.has_train_step_budget()):
+                track.train_data_event.clear()
+                await track.train_data_event.wait()
+                continue
+
+            track.train_step_budget -= 1
+            train_state = await track.schedule_training_job(track.train_step)
+            if train_state:
+                latest_train_state = train_state
+                train_state_event.set()
+
+    async def send_train_states():
+        while True:
+            await train_state_event.wait()
+            train_state_event.clear()
+            await websocket.send(json.dumps({"train_state": latest_train_state}))
+
+    tasks = [
+        asyncio.ensure_future(train()),
+        asyncio.ensure_future(send_train_states()),
+        # Also stop when the connection closes while idle.
+        asyncio.ensure_future(websocket.wait_closed()),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    except websockets.ConnectionClosed:
+        print("ws terminated")
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def enable_persistent_compilation_cache(cache_dir):
+    """Persist compiled XLA executables to disk, so compilation is only paid once across restarts.
+    Returns whether executables for the default backend will actually be persisted."""
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+        # Cache everything - even quick compiles add up to audible dropouts on the first packets.
+        jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    except AttributeError:
+        # Older jax versions only expose the experimental interface.
+        from jax.experimental.compilation_cache import compilation_cache
+
+        compilation_cache.initialize_cache(cache_dir)
+
+    is_active = is_persistent_compilation_cache_active()
+    if not is_active:
+        logger.warning(
+            "This jax version doesn't persist compiled executables on the %s backend. "
+            "Processors will be recompiled on every restart.",
+            jax.default_backend(),
+        )
+    return is_active
+
+
+def is_persistent_compilation_cache_active():
+    try:
+        from jax._src import compilation_cache
+
+        return compilation_cache.is_cache_used(jax.devices()[0].client)
+    except (ImportError, AttributeError):
+        # The experimental cache only persists executables compiled for TPUs.
+        return jax.default_backend() == "tpu"
+
+
+def warmup(processors, buffer_sizes, batch_sizes=(), sample_rate=DEFAULT_SAMPLE_RATE):
+    """Compile the forward (`tick_buffer`) and gradient functions for each processor at each buffer size,
+    with the same shapes and dtypes as the audio and training paths use at runtime.
+    Forward functions are also compiled for batches of clients' buffers of each of `batch_sizes`."""
+    for processor in processors:
+        for buffer_size in buffer_sizes:
+            start_time = time.time()
+            X = np.zeros((NUM_CHANNELS, buffer_size), dtype=np.float32)
+            track = AudioTransformTrack(None, ReplayBuffer(TRAIN_BATCH_SIZE))
+            track.set_processor(processor)
+            for batch_size in batch_sizes:
+                compile_batched_tick_buffer(
+                    processor,
+                    {
+                        "params": track.processor_params,
+                        "state": tree_map(jnp.array, track.processor_state),
+                    },
+                    X,
+                    batch_size,
                 )
-            await asyncio.sleep(0.01)  # boo
-        except websockets.ConnectionClosed:
-            print("ws terminated")
-            break
+            Y = track.process(X, sample_rate)
+            track.record_train_pair(X, Y)
+            track.train_step()
+            logger.info(
+                "Warmed up %s with buffer size %d in %.2fs",
+                processor.NAME,
+                buffer_size,
+                time.time() - start_time,
+            )
 
 
 if __name__ == "__main__":
@@ -364,10 +1015,82 @@ if __name__ == "__main__":
     parser.add_argument(
         "--port", type=int, default=8080, help="Port for HTTP server (default: 8080)"
     )
+    parser.add_argument(
+        "--compilation-cache-dir",
+        default=DEFAULT_COMPILATION_CACHE_DIR,
+        help=f"Directory for the persistent XLA compilation cache (default: {DEFAULT_COMPILATION_CACHE_DIR}). "
+        "Pass an empty string to disable.",
+    )
+    parser.add_argument(
+        "--warmup-processors",
+        default="all",
+        help="Comma-separated names of processors to compile at startup, 'all' (default) or 'none'. "
+        "Processors not warmed up are compiled lazily on their first packet.",
+    )
+    parser.add_argument(
+        "--warmup-buffer-sizes",
+        type=int,
+        nargs="*",
+        default=WARMUP_BUFFER_SIZES,
+        help="Buffer sizes (in samples per channel) to compile at startup "
+        "(default: every size clients' buffers can be adapted to, "
+        f"{', '.join(map(str, WARMUP_BUFFER_SIZES))})",
+    )
+    parser.add_argument(
+        "--warmup-batch-sizes",
+        type=int,
+        nargs="*",
+        default=[2],
+        help="Numbers of clients' buffers batched together to compile at startup (default: 2)",
+    )
+    parser.add_argument(
+        "--training-workers",
+        type=int,
+        default=DEFAULT_TRAINING_WORKERS,
+        help="Number of worker threads running training steps, shared by all clients "
+        f"(default: {DEFAULT_TRAINING_WORKERS})",
+    )
+    parser.add_argument(
+        "--batch-processing-deadline-ms",
+        type=float,
+        default=DEFAULT_BATCH_PROCESSING_DEADLINE_SECONDS * 1000,
+        help="Maximum time a client's buffer waits to be batched with other clients' buffers "
+        f"(default: {DEFAULT_BATCH_PROCESSING_DEADLINE_SECONDS * 1000:g})",
+    )
+    parser.add_argument(
+        "--fuse-chain-ticks",
+        action="store_true",
+        help="Process runs of serial processors with per-sample ticks in a single scan over each buffer",
+    )
+    parser.add_argument(
+        "--iir-parallel-min-buffer-size",
+        type=int,
+        help="Process IIR filter buffers of at least this many samples with a parallel scan "
+        "(default: only when not running on the CPU)",
+    )
     parser.add_argument("--verbose", "-v", action="count")
     args = parser.parse_args()
     logging.basicConfig(level=(logging.DEBUG if args.verbose else logging.INFO))
 
+    serial_processors.FUSE_TICKS = args.fuse_chain_ticks
+    iir_filter.PARALLEL_MIN_BUFFER_SIZE = args.iir_parallel_min_buffer_size
+    if args.compilation_cache_dir:
+        enable_persistent_compilation_cache(args.compilation_cache_dir)
+    if args.warmup_processors == "all":
+        warmup_processors = ALL_PROCESSORS
+    elif args.warmup_processors == "none":
+        warmup_processors = []
+    else:
+        warmup_processors = [
+            processor_by_name[name.strip()]
+            for name in args.warmup_processors.split(",")
+        ]
+    warmup(warmup_processors, args.warmup_buffer_sizes, args.warmup_batch_sizes)
+    training_executor = ThreadPoolExecutor(
+        max_workers=args.training_workers, thread_name_prefix="training"
+    )
+    processing_scheduler = ProcessingScheduler(args.batch_processing_deadline_ms / 1000)
+
     ssl_context = None
     if args.cert_file:
         ssl_context = ssl.SSLContext()
@@ -0,0 +1,289 @@
+import numpy as np
+import jax.numpy as jnp
+import pytest
+from jax import grad, lax
+from jax.tree_util import tree_leaves
+
+from jaxdsp.processors import (
+    allpass_filter,
+    delay_line,
+    fir_filter,
+    freeverb,
+    iir_filter,
+    lowpass_feedback_comb_filter,
+)
+from jaxdsp.processors.block import tick_chunks
+from jaxdsp.processors.processor_graph import INPUT_KEY, ProcessorGraph
+
+NUM_BUFFERS = 4
+
+
+def random_buffers(buffer_size, num_buffers=NUM_BUFFERS, seed=0):
+    rng = np.random.default_rng(seed)
+    return jnp.array(rng.standard_normal((num_buffers, buffer_size), dtype=np.float32))
+
+
+# Consecutive buffers of varying sizes, including buffers shorter than the `MIN_BLOCK_BUFFER_SIZE` of
+# block-processed processors, and sizes that don't divide (or are multiples of) their delay lengths.
+BUFFER_SIZES = [37, 300, 1000, 5, 128, 1116]
+
+
+def random_buffers_of_sizes(buffer_sizes=BUFFER_SIZES, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        jnp.array(rng.standard_normal(buffer_size, dtype=np.float32))
+        for buffer_size in buffer_sizes
+    ]
+
+
+def process_buffers(tick_buffer, params, state, Xs):
+    """Process consecutive buffers, returning the final state and the concatenated output."""
+    Ys = []
+    for X in Xs:
+        carry, Y = tick_buffer({"params": params, "state": state}, X)
+        state = carry["state"]
+        Ys.append(Y)
+    return state, jnp.concatenate(Ys)
+
+
+def assert_trees_close(actual, desired, rtol=1e-5, atol=1e-5):
+    for actual_leaf, desired_leaf in zip(tree_leaves(actual), tree_leaves(desired)):
+        np.testing.assert_allclose(actual_leaf, desired_leaf, rtol=rtol, atol=atol)
+
+
+def scan_ticks(tick):
+    return lambda carry, X: lax.scan(tick, carry, X)
+
+
+def test_iir_filter_parallel_matches_ticks():
+    params = {
+        "B": jnp.array([0.2, 0.3, 0.1, 0.05, 0.02]),
+        "A": jnp.array([1.0, -0.5, 0.2, -0.1, 0.05]),
+    }
+    Xs = random_buffers(300)
+    parallel_state, parallel_Y = process_buffers(
+        iir_filter.tick_buffer_parallel, params, iir_filter.state_init(), Xs
+    )
+    state, Y = process_buffers(
+        scan_ticks(iir_filter.tick), params, iir_filter.state_init(), Xs
+    )
+    assert_trees_close(parallel_Y, Y)
+    assert_trees_close(parallel_state, state)
+
+    def loss(tick_buffer):
+        return lambda params: jnp.sum(
+            process_buffers(tick_buffer, params, iir_filter.state_init(), Xs)[1] ** 2
+        )
+
+    assert_trees_close(
+        grad(loss(iir_filter.tick_buffer_parallel))(params),
+        grad(loss(scan_ticks(iir_filter.tick)))(params),
+        rtol=1e-4,
+        atol=1e-3,
+    )
+
+
+def test_iir_filter_parallel_min_buffer_size(monkeypatch):
+    monkeypatch.setattr(iir_filter, "PARALLEL_MIN_BUFFER_SIZE", 256)
+    assert iir_filter.is_parallel(256)
+    assert not iir_filter.is_parallel(255)
+
+
+@pytest.mark.parametrize("delay_length", [20, 64, 100, 1116])
+@pytest.mark.parametrize(
+    "processor, params",
+    [
+        (lowpass_feedback_comb_filter, {"feedback": 0.7, "damp": 0.3}),
+        (allpass_filter, {"feedback": 0.5}),
+    ],
+    ids=["comb", "allpass"],
+)
+def test_chunks_match_ticks(processor, params, delay_length):
+    Xs = random_buffers_of_sizes()
+    state, Y = process_buffers(
+        scan_ticks(processor.tick),
+        params,
+        processor.state_init(buffer_size=delay_length),
+        Xs,
+    )
+
+    def tick_buffer_chunks(carry, X):
+        return tick_chunks(processor.tick_chunk, carry, X, min(delay_length, X.size))
+
+    for tick_buffer in [tick_buffer_chunks, processor.tick_buffer]:
+        chunked_state, chunked_Y = process_buffers(
+            tick_buffer, params, processor.state_init(buffer_size=delay_length), Xs
+        )
+        assert_trees_close(chunked_Y, Y)
+        assert_trees_close(chunked_state, state)
+
+
+def freeverb_reference_state_init():
+    """Freeverb state as separate comb and allpass filters, as processed by `freeverb_reference_tick`."""
+    comb_tunings = freeverb.scaled_tunings(freeverb.comb_tunings_l, 44100)
+    allpass_tunings = freeverb.scaled_tunings(freeverb.allpass_tunings_l, 44100)
+    return {
+        "combs": [
+            [lowpass_feedback_comb_filter.state_init(size) for size in sizes]
+            for sizes in comb_tunings
+        ],
+        "allpasses": [
+            [allpass_filter.state_init(size) for size in sizes]
+            for sizes in allpass_tunings
+        ],
+    }
+
+
+def freeverb_reference_tick(carry, x):
+    """Freeverb with each comb and allpass filter ticked separately."""
+    params = carry["params"]
+    state = carry["state"]
+    x_l, x_r = jnp.broadcast_to(x, (2,))
+    x_combined = (x_l + x_r) * freeverb.fixed_gain
+    comb_params = {
+        "feedback": params["room_size"] * freeverb.scale_room + freeverb.offset_room,
+        "damp": params["damp"] * freeverb.scale_damp,
+    }
+    allpass_params = {"feedback": freeverb.allpass_feedback}
+    outs = []
+    for channel in range(2):
+        out = 0.0
+        for i, comb_state in enumerate(state["combs"][channel]):
+            comb_carry, comb_out = lowpass_feedback_comb_filter.tick(
+                {"params": comb_params, "state": comb_state}, x_combined
+            )
+            state["combs"][channel][i] = comb_carry["state"]
+            out += comb_out
+        for i, allpass_state in enumerate(state["allpasses"][channel]):
+            allpass_carry, out = allpass_filter.tick(
+                {"params": allpass_params, "state": allpass_state}, out
+            )
+            state["allpasses"][channel][i] = allpass_carry["state"]
+        outs.append(out)
+    out_l, out_r = outs
+
+    wet = params["wet"] * freeverb.scale_wet
+    dry = params["dry"] * freeverb.scale_dry
+    wet_1 = wet * (params["width"] / 2 + 0.5)
+    wet_2 = wet * ((1 - params["width"]) / 2)
+    output_l = out_l * wet_1 + out_r * wet_2 + x_l * dry
+    output_r = out_r * wet_1 + out_l * wet_2 + x_r * dry
+    return carry, jnp.array([output_l, output_r])
+
+
+def assert_delay_bank_matches(bank, filter_states):
+    for channel, channel_states in enumerate(filter_states):
+        for i, filter_state in enumerate(channel_states):
+            size = filter_state["buffer"].size
+            assert int(bank["buffer_size"][channel, i]) == size
+            np.testing.assert_allclose(
+                bank["buffer"][channel, i, :size],
+                filter_state["buffer"],
+                rtol=1e-5,
+                atol=1e-6,
+            )
+            assert int(bank["buffer_index"][channel, i]) == int(
+                filter_state["buffer_index"]
+            )
+            if "filter_store" in bank:
+                np.testing.assert_allclose(
+                    bank["filter_store"][channel, i],
+                    filter_state["filter_store"],
+                    rtol=1e-5,
+                    atol=1e-6,
+                )
+
+
+def transposed_output(tick_buffer):
+    def transposed_tick_buffer(carry, X):
+        carry, Y = tick_buffer(carry, X)
+        return carry, Y.T
+
+    return transposed_tick_buffer
+
+
+def test_freeverb_matches_separate_filters():
+    params = {"wet": 0.3, "dry": 0.6, "width": 0.5, "damp": 0.3, "room_size": 1.055}
+    # Stereo input with different channels, in consecutive buffers longer than the longest comb.
+    Xs = [
+        jnp.stack(buffers)
+        for buffers in zip(
+            random_buffers(2000, 3, seed=0), random_buffers(2000, 3, seed=1)
+        )
+    ]
+    reference_state, reference_Y = process_buffers(
+        lambda carry, X: lax.scan(freeverb_reference_tick, carry, X.T),
+        params,
+        freeverb_reference_state_init(),
+        Xs,
+    )
+
+    state, Y = process_buffers(
+        lambda carry, X: freeverb.tick_buffer(carry, X.T),
+        params,
+        freeverb.state_init(sample_rate=44100),
+        Xs,
+    )
+    assert_trees_close(Y, reference_Y)
+    assert_delay_bank_matches(state["combs"], reference_state["combs"])
+    assert_delay_bank_matches(state["allpasses"], reference_state["allpasses"])
+
+    multichannel_state, multichannel_Y = process_buffers(
+        transposed_output(freeverb.tick_buffer_multichannel),
+        params,
+        freeverb.state_init(sample_rate=44100),
+        Xs,
+    )
+    assert_trees_close(multichannel_Y, reference_Y)
+    assert_trees_close(multichannel_state, state)
+
+
+# Direct, FFT and partitioned FFT convolution.
+@pytest.mark.parametrize("kernel_size", [5, 100, 20_000])
+def test_fir_filter_matches_direct_convolution(kernel_size):
+    B = jnp.array(np.random.default_rng(2).standard_normal(kernel_size) / kernel_size)
+    Xs = random_buffers_of_sizes()
+    X = jnp.concatenate(Xs)
+    state, Y = process_buffers(
+        fir_filter.tick_buffer,
+        {"B": B},
+        fir_filter.state_init(length=kernel_size - 1),
+        Xs,
+    )
+    np.testing.assert_allclose(Y, np.convolve(X, B)[: X.size], rtol=1e-4, atol=1e-4)
+    previous_X = jnp.concatenate([jnp.zeros(kernel_size), X])
+    np.testing.assert_allclose(
+        state["inputs"], jnp.flip(previous_X[-(kernel_size - 1) :])
+    )
+
+
+def test_fir_filter_state_too_short_for_kernel():
+    params = {"B": jnp.ones(100)}
+    carry = {"params": params, "state": fir_filter.state_init()}
+    with pytest.raises(ValueError):
+        fir_filter.tick_buffer(carry, jnp.zeros(64))
+    with pytest.raises(ValueError):
+        fir_filter.tick(carry, 0.0)
+
+
+# The delay line holds 1000 samples, so some buffers overwrite all of it.
+@pytest.mark.parametrize("delay_samples", [0.0, 0.9, 37.5, 999.25, 1000.0])
+def test_delay_line_matches_ticks(delay_samples):
+    params = {"wet": 0.7, "delay_samples": delay_samples}
+    Xs = random_buffers_of_sizes()
+    state = delay_line.state_init(sample_rate=1000)
+    tick_state, tick_Y = process_buffers(
+        lambda carry, X: scan_ticks(delay_line.tick)(delay_line.before_ticks(carry), X),
+        params,
+        state,
+        Xs,
+    )
+    state, Y = process_buffers(delay_line.tick_buffer, params, state, Xs)
+    # `tick` interpolates with a float32 read position, which is imprecise near the end of the delay line.
+    assert_trees_close(Y, tick_Y, atol=2e-4)
+    assert_trees_close(state, tick_state, atol=2e-4)
+
+
+def test_processor_graph_needs_outputs():
+    with pytest.raises(ValueError):
+        ProcessorGraph([("Clip", [INPUT_KEY])], [])
@@ -0,0 +1,141 @@
+import numpy as np
+import jax.numpy as jnp
+import pytest
+from jax.tree_util import tree_leaves
+
+from jaxdsp.loss import LossOptions
+from jaxdsp.processors import (
+    all_processors,
+    default_param_values,
+    multichannel_state,
+    params_to_unit_scale,
+    processor_by_name,
+    processor_key,
+    serial_processors,
+    tick_buffer_multichannel,
+)
+from jaxdsp.processors.processor_graph import INPUT_KEY, ProcessorGraph
+from jaxdsp.training import IterativeTrainer, PopulationTrainer, compiled_grad_fn
+
+NUM_SAMPLES = 4096
+CHECKPOINT_SEGMENT_SIZE = 1000
+
+
+def loss_and_grads(processor, state, X, Y_target, multichannel, segment_size):
+    grad_fn = compiled_grad_fn(
+        processor_key(processor, state),
+        LossOptions(),
+        multichannel,
+        segment_size,
+        False,
+        X.shape,
+        Y_target.shape,
+        X.dtype,
+    )
+    params = params_to_unit_scale(
+        default_param_values(processor, state), processor.NAME
+    )
+    (loss, _), grads = grad_fn(params, state, X, Y_target, None)
+    return loss, grads
+
+
+def assert_checkpointed_matches(processor, state, multichannel):
+    rng = np.random.default_rng(0)
+    shape = (2, NUM_SAMPLES) if multichannel else (NUM_SAMPLES,)
+    X = jnp.array(rng.standard_normal(shape, dtype=np.float32))
+    Y_target = jnp.array(rng.standard_normal(shape, dtype=np.float32))
+    if multichannel:
+        state = multichannel_state(processor, state, 2)
+    elif processor.NAME == "Freeverb":
+        Y_target = Y_target[:, None].repeat(2, axis=1)
+
+    loss, grads = loss_and_grads(processor, state, X, Y_target, multichannel, None)
+    checkpointed_loss, checkpointed_grads = loss_and_grads(
+        processor, state, X, Y_target, multichannel, CHECKPOINT_SEGMENT_SIZE
+    )
+    np.testing.assert_allclose(checkpointed_loss, loss, rtol=1e-4)
+    for checkpointed_grad, grad in zip(
+        tree_leaves(checkpointed_grads), tree_leaves(grads)
+    ):
+        np.testing.assert_allclose(checkpointed_grad, grad, rtol=5e-3, atol=1e-4)
+
+
+@pytest.mark.parametrize("multichannel", [False, True])
+@pytest.mark.parametrize(
+    "processor", all_processors, ids=lambda processor: processor.NAME
+)
+def test_checkpointed_grads_match(processor, multichannel):
+    assert_checkpointed_matches(processor, processor.state_init(), multichannel)
+
+
+@pytest.mark.parametrize("multichannel", [False, True])
+@pytest.mark.parametrize(
+    "processor_names",
+    [
+        ["Lowpass Feedback Comb Filter", "Clip", "Allpass Filter"],
+        ["Feedforward Delay", "Clip"],
+    ],
+)
+def test_checkpointed_grads_match_serial_processors(processor_names, multichannel):
+    processors = [processor_by_name[name] for name in processor_names]
+    assert_checkpointed_matches(
+        serial_processors, serial_processors.state_init(processors), multichannel
+    )
+
+
+@pytest.mark.parametrize("multichannel", [False, True])
+def test_checkpointed_grads_match_processor_graph(multichannel):
+    graph = ProcessorGraph(
+        [
+            ("Feedforward Delay", [INPUT_KEY]),
+            ("Lowpass Feedback Comb Filter", [INPUT_KEY]),
+        ],
+        ["Feedforward Delay", "Lowpass Feedback Comb Filter"],
+    )
+    assert_checkpointed_matches(graph, graph.state_init(), multichannel)
+
+
+def comb_filter_dataset(num_buffers, num_samples=256):
+    processor = processor_by_name["Lowpass Feedback Comb Filter"]
+    rng = np.random.default_rng(0)
+    Xs = rng.standard_normal((num_buffers, num_samples), dtype=np.float32)
+    carry = {"params": {"feedback": 0.8, "damp": 0.3}, "state": processor.state_init()}
+    Y_targets = []
+    for X in Xs:
+        carry, Y_target = processor.tick_buffer(carry, X)
+        Y_targets.append(Y_target)
+    return processor, jnp.array(Xs), jnp.stack(Y_targets)
+
+
+def iterative_losses(processor, params_init, Xs, Y_targets, num_steps):
+    trainer = IterativeTrainer(processor, processor_params=dict(params_init))
+    losses = []
+    for i in range(num_steps):
+        trainer.step(Xs[i % len(Xs)], Y_targets[i % len(Xs)])
+        losses.append(float(trainer.loss))
+    return losses
+
+
+def test_population_matches_iterative_trainer():
+    processor, Xs, Y_targets = comb_filter_dataset(10)
+    params_inits = [{"feedback": 0.2, "damp": 0.6}, {"feedback": 0.5, "damp": 0.1}]
+    trainer = PopulationTrainer(processor, params_inits)
+    loss_history = trainer.train(Xs, Y_targets, 15)
+    for params_init, losses in zip(params_inits, loss_history):
+        np.testing.assert_allclose(
+            losses,
+            iterative_losses(processor, params_init, Xs, Y_targets, 15),
+            rtol=1e-4,
+        )
+
+
+def test_on_device_training_matches_steps():
+    processor, Xs, Y_targets = comb_filter_dataset(10)
+    params_init = {"feedback": 0.2, "damp": 0.6}
+    trainer = IterativeTrainer(processor, processor_params=dict(params_init))
+    losses = np.concatenate(
+        [trainer.train(Xs, Y_targets, 10)[0], trainer.train(Xs, Y_targets, 10)[0]]
+    )
+    np.testing.assert_allclose(
+        losses, iterative_losses(processor, params_init, Xs, Y_targets, 20), rtol=1e-4
+    )